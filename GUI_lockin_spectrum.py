@@ -4,7 +4,7 @@ log.addHandler(logging.NullHandler())
 
 import sys
 from PySide6.QtWidgets import QTreeWidget, QTreeWidgetItem
-from time import sleep, time
+from time import sleep
 from datetime import datetime
 from pymeasure.log import console_log
 from pymeasure.display.Qt import QtWidgets
@@ -15,14 +15,16 @@ from pymeasure.display.widgets import TableWidget, LogWidget
 from PlotSpectrumWidget import SpectrumPlotWidget
 from InstrumentControlWidget import InstrumentControltWidget
 from PlotDataWidget import PlotDataWidget
-from pymeasure.experiment import Procedure, Results, IntegerParameter, FloatParameter, Parameter, BooleanParameter
-from dsp72XX_ar import DSP72XX_ar
-from sr830_ar import SR830_ar
-from dsp52XX_ar import DSP52XX_ar
+from pymeasure.experiment import Procedure, Results, IntegerParameter, FloatParameter, Parameter, BooleanParameter, ListParameter
+from acquisition import InstrumentReader, READ_MODES, THREADED
+from columnar_results import open_writer, DATA_FORMATS, NO_BINARY
+from buffered_results import buffer_results
+from instrument_setup import open_lockin, close_lockin, run_concurrently, progress_dialog
 
 from pymeasure.display.Qt import QtWidgets
 
 delay = 0.1 # 0.1s delay in taking measurements for communication time
+live_view_points = 200000 # rows kept in memory by the dock plots, older rows are read from the data file when zooming out
 
 class SetupWindow(QtWidgets.QMainWindow):
     """
@@ -115,8 +117,15 @@ class SetupWindow(QtWidgets.QMainWindow):
 
         widget_list = (SpectrumPlotWidget(name="Spectrum"),)
 
-        lockin_var = [None]*len(lockin_ports)
-        
+        # connect to every lock-in at once, setup takes as long as the slowest instrument
+        jobs = [('Lock-In ' + str(i+1) + ' (' + lockin_models[i] + ' ' + lockin_ports[i] + ')',
+                 open_lockin, (lockin_models[i], lockin_ports[i]), close_lockin) for i in range(len(lockin_ports))]
+        dialog, progress = progress_dialog(self, len(jobs))
+        try:
+            lockin_var = run_concurrently(jobs, progress)
+        finally:
+            dialog.close()
+
         for i in range(len(lockin_ports)):
             if lockin_models[i] ==  'DSP52XX':
                 y_axes_labels.append('Lock-In ' + str(i+1) + ' - X (V)')
@@ -126,12 +135,6 @@ class SetupWindow(QtWidgets.QMainWindow):
                 y_axes_labels.append('Lock-In ' + str(i+1) + ' - Y (V)')
                 y_axes_labels.append('Lock-In ' + str(i+1) + ' - Frequency (Hz)')
                 y_axes_labels.append('Lock-In ' + str(i+1) + ' - Osc Amp (V)')
-            if lockin_models[i] == 'SR830':
-                    lockin_var[i] = SR830_ar(lockin_ports[i])
-            elif lockin_models[i] == 'DSP72XX': 
-                    lockin_var[i] = DSP72XX_ar(lockin_ports[i])
-            elif lockin_models[i] == 'DSP52XX':
-                    lockin_var[i] = DSP52XX_ar(lockin_ports[i],timeout=12000) # use 12000ms timeouts because dsp52XX sometimes take a long time to reply, also add a bit of query delay to allow for time between write and read
 
             if lockin_models[i] ==  'DSP52XX':
                 data_columns.append('Lock-In ' + str(i+1) + ' - X (V)')
@@ -142,6 +145,9 @@ class SetupWindow(QtWidgets.QMainWindow):
                 data_columns.append('Lock-In ' + str(i+1) + ' - Frequency (Hz)')
                 data_columns.append('Lock-In ' + str(i+1) + ' - Osc Amp (V)')
 
+            data_columns.append('Lock-In ' + str(i+1) + ' - Settling') # 1 while auto-range is changing the sensitivity
+            data_columns.append('Lock-In ' + str(i+1) + ' - Time (s)') # time of the lock-in reading
+
             widget_list = widget_list + (InstrumentControltWidget(name=lockin_ports[i]+" " + lockin_models[i],instrument=lockin_var[i]),)
 
         class MainWindow(ManagedDockWindow_2plot):
@@ -151,69 +157,76 @@ class SetupWindow(QtWidgets.QMainWindow):
                 class TestProcedure(Procedure):
 
                     DATA_COLUMNS = data_columns
+                    read_mode = ListParameter('Instrument read mode', choices=READ_MODES, default=THREADED)
+                    stream_buffers = BooleanParameter('Stream lock-in buffers (72XX 800 Hz, SR830 512 Hz)', default=False)
+                    data_format = ListParameter('Binary data file', choices=DATA_FORMATS, default=NO_BINARY)
+                    flush_interval = FloatParameter('Data file flush interval (0 for every row)', units='s', default=1, minimum=0)
+                    data_filename = None # set by MainWindow.queue, used to name the buffer stream files
+
                     def __init__(self, **kwargs):
                         self.DATA_COLUMNS = data_columns
                         super().__init__(**kwargs)
 
-                    def acquire_data(self,startT):
+                    def acquire_data(self):
+                        # monotonic, same time origin as the instrument timestamps
+                        elapsed = round(self.reader.clock.elapsed(),3)
                         data = {
-                            'Elapsed Time (s)': round(time()-startT,3)}
-                        data['Elapsed Time (hr)'] = round(time()-startT,3)/3600
-                        for i in range(len(lockin_ports)):
-                            if lockin_models[i] ==  'DSP52XX':
-                                ### Check manually if auto-range is needed
-                                ### 52XX is slow in responding so one needs to delay between ask and write
-
-                                if abs(int(lockin_var[i].ask("MAG"))) > 9000 or abs(int(lockin_var[i].ask("MAG"))) < 2000:
-                                    ### need to change sensitivity, then change time constant to 0.1s to capture the quick change
-                                    current_tc = int(lockin_var[i].ask("TC"))
-                                    lockin_var[i].write("TC 4")
-                                    while abs(int(lockin_var[i].ask("MAG"))) > 9000 or abs(int(lockin_var[i].ask("MAG"))) < 1000:
-                                        current_sen = int(lockin_var[i].ask("SEN"))
-                                        if abs(int(lockin_var[i].ask("MAG"))) > 9000:
-                                            lockin_var[i].write("SEN %d" % (current_sen + 1))
-                                        elif abs(int(lockin_var[i].ask("MAG"))) < 1000:
-                                            lockin_var[i].write("SEN %d" % (current_sen - 1))
-                                        sleep(1) # give lock-in 1s to respond before checking again
-                                    ### change back to measurement TC after we're finished
-                                    lockin_var[i].write("TC %d" % current_tc)
-                                    sleep(10) ### give lock-in 10s to settle before measuring
-
-                                data['Lock-In ' + str(i+1) + ' - X (V)'] = lockin_var[i].x
-                                sleep(delay)
-                                data['Lock-In ' + str(i+1) + ' - Y (V)'] = lockin_var[i].y
-                                sleep(delay)
-                            else:
-                                lockin_var[i].auto_range() # auto-range before acquiring data, auto_sensitivity doesn't work due to weird time-out problems
-                                data['Lock-In ' + str(i+1) + ' - X (V)'] = lockin_var[i].x
-                                data['Lock-In ' + str(i+1) + ' - Y (V)'] = lockin_var[i].y
-                                data['Lock-In ' + str(i+1) + ' - Frequency (Hz)'] = lockin_var[i].frequency
-                                data['Lock-In ' + str(i+1) + ' - Osc Amp (V)'] = lockin_var[i].voltage
+                            'Elapsed Time (s)': elapsed}
+                        data['Elapsed Time (hr)'] = elapsed/3600
+                        data.update(self.reader.read())
                         self.emit('results', data)
+                        if self.writer is not None:
+                            self.writer.append(data)
                         # self.emit('progress', 100 * (i + 1) / self.iterations) ### for giving a progress bar
                         log.debug("Emitting results: %s" % data)    
         
                     def startup(self):
                         log.info("Starting measurement interface")
+                        # set first, so shutdown after a failed startup does not hide the error
+                        self.results_handlers = []
+                        self.reader = None
+                        self.writer = None
+                        # rows written in batches, at most flush_interval seconds of data are lost in a crash
+                        self.results_handlers = buffer_results(self, max_delay=self.flush_interval)
+                        stream_file = None
+                        if self.stream_buffers and self.data_filename is not None:
+                            stream_file = self.data_filename[:-4] # strip .txt
+                        if self.data_filename is not None:
+                            # written alongside the .txt file, which still feeds the plots
+                            self.writer = open_writer(self.data_filename, self.DATA_COLUMNS,
+                                                      metadata=self.parameter_values(),
+                                                      data_format=self.data_format)
+                        self.reader = InstrumentReader(None, lockin_var, lockin_models,
+                                                       reference=True, mode=self.read_mode,
+                                                       stream_file=stream_file)
 
                     def execute(self):
-                        startT = time()
-        
                         # Default
                         while True:
-                            self.acquire_data(startT)
+                            self.acquire_data()
                             sleep(delay)
         
                             if self.should_stop():
                                 log.warning("Caught the stop flag in the procedure")
                                 break
 
+                    def shutdown(self):
+                        for handler in self.results_handlers:
+                            handler.flush()
+                        if self.reader is not None:
+                            self.reader.shutdown()
+                        if self.writer is not None:
+                            self.writer.close()
+
                 super().__init__(
                     procedure_class=TestProcedure,
+                    inputs=['read_mode', 'stream_buffers', 'data_format', 'flush_interval'],
                     x_axis=['Elapsed Time (s)'],
                     y_axis=y_axes_labels,
                     widget_list=widget_list,
                     sequencer=False,
+                    align_timestamps=True,
+                    live_points=live_view_points,
                 )
                 self.setWindowTitle('Maxview PPMS')
                 self.directory = r'C:\\Users\\rt505\\OneDrive - University of Cambridge\\Desktop\\PhD\\MaxView\\'
@@ -225,6 +238,7 @@ class SetupWindow(QtWidgets.QMainWindow):
 
                 if procedure is None:
                     procedure = self.make_procedure()
+                procedure.data_filename = filename
 
                 results = Results(procedure, filename)
                 experiment = self.new_experiment(results)
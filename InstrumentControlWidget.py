@@ -12,23 +12,83 @@ from pymeasure.display.widgets.tab_widget import TabWidget
 from scipy.optimize import curve_fit
 ##from datetime import datetime
 ##from seabreeze.spectrometers import Spectrometer
-from time import sleep
 ##import serial
+from instrument_broker import broker_for
+from autorange import ranger_for
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 delay = 0.1
+RANGE_POLL_TIME = 0.1 # seconds between auto-range steps of Measure XY
 
 class InstrumentControltWidget(TabWidget, QtWidgets.QWidget):
     """ Tab for communicating with instrument via GPIB
+
+    Every instrument access runs on the instrument's broker thread, results are
+    posted back to the GUI thread with the job_done signal, so a slow lock-in
+    never freezes the window. The entries are filled in once the first reads
+    come back.
     """
+    ### (callback, result) of a finished job, and (description, exception) of a failed one
+    job_done = QtCore.Signal(object, object)
+    job_failed = QtCore.Signal(str, object)
 
     def __init__(self, name, instrument, parent=None):
         super().__init__(name, parent)
         self.instrument = instrument
         self.model = self.instrument.model
+        ### shared with the measurement procedure, which has priority over this tab
+        self.broker = broker_for(instrument)
+        ### the SR830 calls the oscillator amplitude sine_voltage, the DSP lock-ins voltage
+        self.amplitude_name = 'sine_voltage' if self.model == "SR830" else 'voltage'
+        self.job_done.connect(self._deliver)
+        self.job_failed.connect(self._report)
         self._setup_ui()
         self._layout()
+        if self.model == "DSP72XX" or self.model == "DSP52XX" or self.model == "SR830":
+            self.run_job(self._read_settings, self._fill_entries, "reading settings")
+
+    def run_job(self, function, callback, description, *args):
+        """ Run function(*args) on the broker thread and call callback with its
+            result on the GUI thread.
+        """
+        future = self.broker.submit(function, *args)
+        future.add_done_callback(lambda f: self._finished(f, callback, description))
+        return future
+
+    def _finished(self, future, callback, description):
+        ### runs on the broker thread, the signals are queued to the GUI thread
+        exception = future.exception()
+        if exception is not None:
+            self.job_failed.emit(description, exception)
+        else:
+            self.job_done.emit(callback, future.result())
+
+    def _deliver(self, callback, result):
+        callback(result)
+
+    def _report(self, description, exception):
+        log.error(self.name + " failed " + description + ": " + repr(exception))
+
+    def _read_settings(self):
+        return {'amplitude': getattr(self.instrument, self.amplitude_name),
+                'frequency': self.instrument.frequency,
+                'sensitivity': self.instrument.sensitivity,
+                'time_constant': self.instrument.time_constant,
+                'xy': self.instrument.xy}
+
+    def _fill_entries(self, values):
+        self.OAentry.setText(str(values['amplitude']))
+        self.OFentry.setText(str(values['frequency']))
+        self.SENentry.setText(str(values['sensitivity']))
+        self.TCentry.setText(str(values['time_constant']))
+        self.Xentry.setText(str(values['xy'][0]))
+        self.Yentry.setText(str(values['xy'][1]))
+
+    def _set_and_read(self, name, value):
+        """ Set a property and read it back, as the lock-ins truncate the value. """
+        setattr(self.instrument, name, value)
+        return getattr(self.instrument, name)
 
     def _setup_ui(self):
         self.delay = 0.1 # delay time in sending GPIB command
@@ -59,17 +119,6 @@ class InstrumentControltWidget(TabWidget, QtWidgets.QWidget):
             self.GPIBCommandentry = QtWidgets.QLineEdit()
             self.GPIBReturnlabel = QtWidgets.QLabel(text='GPIB return: ')
             self.GPIBReturnentry = QtWidgets.QLineEdit()
-
-            if self.model == "SR830":
-                self.OAentry.setText(str(self.instrument.sine_voltage))
-                self.OFentry.setText(str(self.instrument.frequency))
-                self.SENentry.setText(str(self.instrument.sensitivity))
-                self.TCentry.setText(str(self.instrument.time_constant))
-            else:
-                self.OAentry.setText(str(self.instrument.voltage))
-                self.OFentry.setText(str(self.instrument.frequency))
-                self.SENentry.setText(str(self.instrument.sensitivity))
-                self.TCentry.setText(str(self.instrument.time_constant))
         elif self.model == "DSP52XX":
             self.setOAButton = QtWidgets.QPushButton(text='Set amplitude')
             self.setOAButton.clicked.connect(self.set_OA)
@@ -87,14 +136,6 @@ class InstrumentControltWidget(TabWidget, QtWidgets.QWidget):
             self.SENentry = QtWidgets.QLineEdit()
             self.TClabel = QtWidgets.QLabel(text='Time constant (s): ')
             self.TCentry = QtWidgets.QLineEdit()
-            self.OAentry.setText(str(self.instrument.voltage))
-            sleep(delay)
-            self.OFentry.setText(str(self.instrument.frequency))
-            sleep(delay)
-            self.SENentry.setText(str(self.instrument.sensitivity))
-            sleep(delay)
-            self.TCentry.setText(str(self.instrument.time_constant))
-            sleep(delay)
 
             self.sendCommandButton = QtWidgets.QPushButton(text='Send GPIB command')
             self.sendCommandButton.clicked.connect(self.send_command)
@@ -106,18 +147,18 @@ class InstrumentControltWidget(TabWidget, QtWidgets.QWidget):
             self.GPIBReturnlabel = QtWidgets.QLabel(text='GPIB return: ')
             self.GPIBReturnentry = QtWidgets.QLineEdit()
 
-            self.notelabel = QtWidgets.QLabel(text='Do not use this tab or GPIB query when a measurement is going on, DSP52XX will mess up the queries and the program will abort the measurement due to timeout. <br/> Also, the measurement might not queue at first due to communication problem. Just hit the button again.')
+            self.notelabel = QtWidgets.QLabel(text='The measurement might not queue at first due to communication problem. Just hit the button again.')
         
         if self.model == "DSP72XX" or self.model == "DSP52XX" or self.model == "SR830":
-            XY_init = self.instrument.xy
             self.Xlabel = QtWidgets.QLabel(text='X (V) : ')
             self.Xentry = QtWidgets.QLineEdit()
             self.Ylabel = QtWidgets.QLabel(text='Y (V) : ')
             self.Yentry = QtWidgets.QLineEdit()
-            self.Xentry.setText(str(XY_init[0]))
-            self.Yentry.setText(str(XY_init[1]))
             self.measureXYButton = QtWidgets.QPushButton(text='Measure XY')
             self.measureXYButton.clicked.connect(self.measure_XY)
+            ### filled in lazily by _fill_entries
+            for entry in (self.OAentry, self.OFentry, self.SENentry, self.TCentry, self.Xentry, self.Yentry):
+                entry.setPlaceholderText('reading...')
 
     def _layout(self):
         vbox = QtWidgets.QVBoxLayout(self)
@@ -244,92 +285,74 @@ class InstrumentControltWidget(TabWidget, QtWidgets.QWidget):
 
     def set_OA(self):
         amplitude = float(self.OAentry.text())
-        if self.model == "SR830":
-            self.instrument.sine_voltage = amplitude
-            self.OAentry.setText(str(self.instrument.sine_voltage))
-            log.info(self.name + " oscillation voltage set to " + self.OAentry.text() + " V")
-        elif self.model == "DSP72XX":
-            self.instrument.voltage = amplitude
-            self.OAentry.setText(str(self.instrument.voltage))
-            log.info(self.name + " oscillation voltage set to " + self.OAentry.text() + " V")
-        elif self.model == "DSP52XX":
-            self.instrument.voltage = amplitude
-            sleep(delay)
-            self.OAentry.setText(str(self.instrument.voltage))
+        def done(value):
+            self.OAentry.setText(str(value))
             log.info(self.name + " oscillation voltage set to " + self.OAentry.text() + " V")
+        self.run_job(self._set_and_read, done, "setting the amplitude", self.amplitude_name, amplitude)
 
     def set_OF(self):
         frequency = float(self.OFentry.text())
-        if self.model == "SR830" or self.model == "DSP72XX":
-            self.instrument.frequency = frequency
-            self.OFentry.setText(str(self.instrument.frequency))
-            log.info(self.name + " oscillation frequency set to " + self.OFentry.text() + " Hz")
-        elif self.model == "DSP52XX":
-            self.instrument.frequency = frequency
-            sleep(delay)
-            self.OFentry.setText(str(self.instrument.frequency))
+        def done(value):
+            self.OFentry.setText(str(value))
             log.info(self.name + " oscillation frequency set to " + self.OFentry.text() + " Hz")
+        self.run_job(self._set_and_read, done, "setting the frequency", 'frequency', frequency)
     
     def set_SEN(self):
+        ### sr830 automatically truncates input value, so input can be just a float value,
+        ### but dsp72xx only implemented discrete values allowed (should be modified now to allow any value)
         sensitivity = float(self.SENentry.text())
-        if self.model == "SR830" or self.model == "DSP72XX":
-            ### sr830 automatically truncates input value, so input can be just a float value,
-            ### but dsp72xx only implemented discrete values allowed (should be modified now to allow any value)
-            self.instrument.sensitivity = sensitivity
-            self.SENentry.setText(str(self.instrument.sensitivity))
-            log.info(self.name + " sensitivity set to " + str(self.instrument.sensitivity) + " V")
-        elif self.model == "DSP52XX":
-            self.instrument.sensitivity = sensitivity
-            sleep(delay)
-            self.SENentry.setText(str(self.instrument.sensitivity))
-            log.info(self.name + " sensitivity set to " + str(self.instrument.sensitivity) + " V")
-
+        def done(value):
+            self.SENentry.setText(str(value))
+            log.info(self.name + " sensitivity set to " + str(value) + " V")
+        self.run_job(self._set_and_read, done, "setting the sensitivity", 'sensitivity', sensitivity)
 
     def set_TC(self):
         time_constant = float(self.TCentry.text())
-        if self.model == "SR830" or self.model == "DSP72XX":
-            ### sr830 automatically truncates input value, so input can be just a float value,
-            ### but dsp72xx only implemented discrete values allowed (should be modified now to allow any value)
-            self.instrument.time_constant = time_constant
-            self.TCentry.setText(str(self.instrument.time_constant))
-            log.info(self.name + " time constant set to " + str(self.instrument.time_constant) + " s")
-        elif self.model == "DSP52XX":
-            self.instrument.time_constant = time_constant
-            sleep(delay)
-            self.TCentry.setText(str(self.instrument.time_constant))
-            log.info(self.name + " time constant set to " + str(self.instrument.time_constant) + " s")
-
+        def done(value):
+            self.TCentry.setText(str(value))
+            log.info(self.name + " time constant set to " + str(value) + " s")
+        self.run_job(self._set_and_read, done, "setting the time constant", 'time_constant', time_constant)
 
     def send_command(self):
         command = self.GPIBCommandentry.text()
-        self.instrument.write(command)
-        log.info("Command " + command + " sent to " + self.name)
+        def done(result):
+            log.info("Command " + command + " sent to " + self.name)
+        self.run_job(self.instrument.write, done, "sending " + command, command)
 
     def query_command(self):
         command = self.GPIBCommandentry.text()
-        query = self.instrument.ask(command)
-        self.GPIBReturnentry.setText(query)
-        log.info("Query " + command + " sent to " + self.name + ", return is " + query)
+        def done(query):
+            self.GPIBReturnentry.setText(query)
+            log.info("Query " + command + " sent to " + self.name + ", return is " + query)
+        self.run_job(self.instrument.ask, done, "querying " + command, command)
+
+    def _read_xy(self):
+        return self.instrument.xy, self.instrument.sensitivity
 
     def measure_XY(self):
-        """ Measure the X and Y voltages measured by a lockin and 
-        return a 2-element list of floating point values.
+        """ Auto-range the lockin, then measure the X and Y voltages and show them
+        with the new sensitivity.
+
+        The lock-in's shared AutoRanger is stepped one job at a time, so reads of a
+        running procedure are not held up while it ranges.
         """
-        if self.model == "DSP72XX" or self.model == "DSP52XX":
-            self.instrument.auto_range()
-            XY = self.instrument.xy
-            self.Xentry.setText(str(XY[0]))
-            self.Yentry.setText(str(XY[1]))
-            log.info(self.name + " measures voltage X = " + str(XY[0]) + ", Y = " + str(XY[1]))
-            self.SENentry.setText(str(self.instrument.sensitivity))
-            log.info(self.name + " sensitivity set to " + str(self.instrument.sensitivity) + " V")
-        elif self.model == "DSP52XX":
-            self.instrument.auto_range()
-            sleep(delay)
-            XY = self.instrument.xy
+        ranger = ranger_for(self.instrument)
+        def stepped(ranging):
+            if ranging:
+                QtCore.QTimer.singleShot(int(RANGE_POLL_TIME*1000), step)
+            else:
+                self.run_job(self._read_xy, done, "measuring XY")
+        def step():
+            if ranger.streamed:
+                # the buffer streamer ranges between chunks, a range change mid-chunk would scale it wrongly
+                stepped(False)
+            else:
+                self.run_job(ranger.step, stepped, "auto-ranging")
+        def done(result):
+            XY, sensitivity = result
             self.Xentry.setText(str(XY[0]))
             self.Yentry.setText(str(XY[1]))
             log.info(self.name + " measures voltage X = " + str(XY[0]) + ", Y = " + str(XY[1]))
-            sleep(delay)
-            self.SENentry.setText(str(self.instrument.sensitivity))
-            log.info(self.name + " sensitivity set to " + str(self.instrument.sensitivity) + " V")
\ No newline at end of file
+            self.SENentry.setText(str(sensitivity))
+            log.info(self.name + " sensitivity set to " + str(sensitivity) + " V")
+        step()
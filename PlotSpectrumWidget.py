@@ -9,11 +9,11 @@ from pymeasure.display.Qt import QtCore, QtWidgets
 from pymeasure.display.widgets.tab_widget import TabWidget
 ##from pymeasure.display.widgets.plot_frame import PlotFrame
 import numpy as np
-from scipy.optimize import curve_fit
 from datetime import datetime
-from seabreeze.spectrometers import Spectrometer
-from time import sleep
-import serial
+from data_loader import load_spectrum
+from spectrometer_session import SpectrometerSession, LiveSpectrum, IDLE_TIMEOUT
+from spectrum_processing import boxcar
+from ruby_fit import fit_ruby, ruby_pressure, model, PROFILES
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -25,12 +25,8 @@ class SpectrumCurve(pg.PlotDataItem):
     def __init__(self, filename, peakmax, wdg=None, **kwargs):
         super().__init__(**kwargs)
         #"C:/Users/rt505/OneDrive - University of Cambridge/Desktop/PhD/MaxView/240112_ambient test in probe ruby 100ms 1 scan binary.txt"
-        with open(filename) as f:
-            n = len(list(f))
-        sp = np.loadtxt(filename,skiprows=17,max_rows=n-17-2)
-        sp_l = sp[:,0]
-        sp_a = sp[:,1]
-        ind_fit=[i for i in range(len(sp_l)) if sp_l[i] < peakmax and sp_l[i] > 690] # lower bound is 690 nm
+        sp_l, sp_a, header = load_spectrum(filename)
+        ind_fit = (sp_l < peakmax) & (sp_l > 690) # lower bound is 690 nm
         sp_a_fit=sp_a[ind_fit]
         sp_l_fit=sp_l[ind_fit]
         self.setData(sp_l_fit, sp_a_fit)
@@ -96,6 +92,8 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
     def _setup_ui(self):
         self.delay = 0.1 # delay time in sending serial command
         self.timeout = 10 # 10 second time-out for serial communication
+        self.idle_timeout = IDLE_TIMEOUT # release the spectrometer and laser module after 5 minutes unused
+        self.session = None
 
         self.loadButton = QtWidgets.QPushButton(text='Load')
         self.loadButton.clicked.connect(self.loadfilename)
@@ -103,6 +101,15 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         self.measureButton.clicked.connect(self.meas_spec)
         self.fitButton = QtWidgets.QPushButton(text='Fit')
         self.fitButton.clicked.connect(self.fit_gaussian)
+        self.liveButton = QtWidgets.QPushButton(text='Live')
+        self.liveButton.setCheckable(True)
+        self.liveButton.toggled.connect(self.toggle_live)
+        ### live spectra are acquired on a thread, the plot is updated from the newest one by a timer
+        self.live = None
+        self.live_count = 0
+        self.display_interval = 50 # ms between live plot updates
+        self.live_timer = QtCore.QTimer(self)
+        self.live_timer.timeout.connect(self.update_live)
 
         self.peakwaveentry = QtWidgets.QLineEdit()
         self.peakwaveentry.setText("694.3")
@@ -141,21 +148,24 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         self.sercomButton = QtWidgets.QPushButton(text='Write serial command')
         self.sercomButton.clicked.connect(self.write_serial_command)
 
-        self.fitnumlabel = QtWidgets.QLabel(text='Fit points on either side of peak')
+        self.fitnumlabel = QtWidgets.QLabel(text='Fit window (peak widths)')
         self.fitnumentry = QtWidgets.QLineEdit()
         self.fitnumentry.setText("5")
 
-        self.peakwidthlabel = QtWidgets.QLabel(text='Peak width estimate')
+        self.peakprofile = QtWidgets.QComboBox()
+        self.peakprofile.addItems(PROFILES)
+
+        self.peakwidthlabel = QtWidgets.QLabel(text='Fitted peak width')
         self.peakwidthentry = QtWidgets.QLineEdit()
-        self.peakwidthentry.setText("0.1")
+        self.peakwidthentry.setReadOnly(True) # filled in by fit_gaussian
 
-        self.peakheightlabel = QtWidgets.QLabel(text='Peak height estimate')
+        self.peakheightlabel = QtWidgets.QLabel(text='Fitted peak height')
         self.peakheightentry = QtWidgets.QLineEdit()
-        self.peakheightentry.setText("11000")
+        self.peakheightentry.setReadOnly(True) # filled in by fit_gaussian
 
-        self.bkglabel = QtWidgets.QLabel(text='Background estimate')
+        self.bkglabel = QtWidgets.QLabel(text='Fitted background')
         self.bkgentry = QtWidgets.QLineEdit()
-        self.bkgentry.setText("4000")
+        self.bkgentry.setReadOnly(True) # filled in by fit_gaussian
 
         self.maxwavelabel = QtWidgets.QLabel(text='Max wavelength plotted')
         self.maxwaveentry = QtWidgets.QLineEdit()
@@ -191,6 +201,7 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         filebox.addWidget(self.fileentry)
         filebox.addWidget(self.loadButton)
         filebox.addWidget(self.measureButton)
+        filebox.addWidget(self.liveButton)
         filebox.addWidget(self.fitButton)
         filebox.addWidget(self.peakwaveentry)
         filebox.addWidget(self.quickfitButton)
@@ -222,6 +233,7 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         fitspecbox.setContentsMargins(-1, 6, -1, 6)
         fitspecbox.addWidget(self.fitnumlabel)
         fitspecbox.addWidget(self.fitnumentry)
+        fitspecbox.addWidget(self.peakprofile)
         fitspecbox.addWidget(self.peakwidthlabel)
         fitspecbox.addWidget(self.peakwidthentry)
         fitspecbox.addWidget(self.peakheightlabel)
@@ -342,9 +354,6 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
     def clear_widget(self):
         self.plot.clear()
 
-    def gaussian(self, x, m, s, A, B): # x must be first independent variable for fitting
-        return A*np.exp(-np.power(x-m,2)/2/s/s) + B
-
     def RT_calibration(self, l):
         # same as 300K calibration but use lambda0=694.3nm measured by Patricia on our rubies
         return 19040/7.665*(np.power((l/694.3),7.665)-1)
@@ -358,24 +367,24 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         R1_peak_300K = 1e7/(14423+4.49e-2*300-4.81e-4*300*300+3.71e-7*300*300*300)
         return 19040/7.665*(np.power(((l-R1_peak+R1_peak_300K)/R1_peak_300K),7.665)-1)
     
-    def fit_gaussian(self):
-        # Fit background from peak in intenstiy as function of wavelength for fitnumentry points above and below peak
-        # to a Gaussian and return the fit function, fit parameters and parameter covariances
-        # fit parameter initial guess is peakwaveentry, peakwidthentry, peakheightentry, bkgentry
-        # output pressure from calibration function cal, error in pressure (positive and negative)
-        N = int(self.fitnumentry.text())
-        s = float(self.peakwidthentry.text())
-        A = float(self.peakheightentry.text())
-        B = float(self.bkgentry.text())
-        peakmax = float(self.maxwaveentry.text())
+    def calibration(self):
+        # return the ruby calibration function chosen in the drop down menu, at the temperature in temperatureentry
         T = float(self.temperatureentry.text())
         calibration = self.rubycalibration.currentText()
         if calibration == "4.5K calibration":
-            cal = lambda x: self.calibration_with_4p5K_fit(x,T)
+            return lambda x: self.calibration_with_4p5K_fit(x,T)
         elif calibration == "300K calibration":
-            cal = lambda x: self.calibration_with_300K_fit(x,T)
+            return lambda x: self.calibration_with_300K_fit(x,T)
         elif calibration == "RT calibration":
-            cal = self.RT_calibration
+            return self.RT_calibration
+
+    def fit_gaussian(self):
+        # Fit the R1 and R2 ruby lines of the plotted spectrum with fit_ruby, which seeds itself from the data,
+        # within fitnumentry peak widths of the peaks, and output pressure from calibration function cal,
+        # error in pressure (positive and negative). The peak width, height and background entries are
+        # updated with the fitted values
+        window = float(self.fitnumentry.text())
+        cal = self.calibration()
 
         if len(self.plot.listDataItems()) > 0:
             # use currently plotted data for fit
@@ -388,28 +397,24 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
             curve = self.load(self.new_spectrum_curve())
             sp_l, sp_a = curve.getData()
 
-        # ind_fit=[i for i in range(len(sp_l)) if sp_l[i] < peakmax]
-        # sp_a_fit=sp_a[ind_fit]
-        ind_peak=np.argmax(sp_a)
-        peak = sp_l[ind_peak]
-        fit_L=sp_l[(ind_peak-N):(ind_peak+N)]
-        fit_A=sp_a[(ind_peak-N):(ind_peak+N)]
-        popt, pcov = curve_fit(self.gaussian, fit_L, fit_A, p0=[peak,s,A,B])
-        fit_fn = lambda x: self.gaussian(x, *popt)
-
-        p=cal(popt[0])
-        ppos=cal(popt[0]+np.sqrt(pcov[0,0]))
-        pneg=cal(popt[0]-np.sqrt(pcov[0,0]))
-
-        output = "p = " + '{:.4f}'.format(p) + " kbar, [" + '{:.4f}'.format(ppos) + ", " + '{:.4f}'.format(pneg) + "] kbar" + ", Peak = " + '{:.4f}'.format(popt[0]) + " nm, Width = " + '{:.4f}'.format(popt[1])+ ", Height = " + '{:.4f}'.format(popt[2])+ ", Background = " + '{:.4f}'.format(popt[3])
-        log.info("Fitted peak with gaussian, obtained following fit parameters: " + output)
-        mesh = np.linspace(sp_l[ind_peak-N],sp_l[ind_peak+N],100)
+        try:
+            fit = fit_ruby(sp_l, sp_a, profile=self.peakprofile.currentText(), window=window)
+        except (ValueError, RuntimeError) as e:
+            log.error("Ruby fit failed: " + str(e))
+            return
+        fit_fn = lambda x: model(x, fit.params, fit.profile)
+
+        p, ppos, pneg = ruby_pressure(fit, cal)
+
+        output = "p = " + '{:.4f}'.format(p) + " kbar, [" + '{:.4f}'.format(ppos) + ", " + '{:.4f}'.format(pneg) + "] kbar" + ", Peak = " + '{:.4f}'.format(fit.peak) + " +- " + '{:.4f}'.format(fit.peak_error) + " nm, R2 peak = " + '{:.4f}'.format(fit.r2_peak) + " nm, Width = " + '{:.4f}'.format(fit.width)+ ", Height = " + '{:.4f}'.format(fit.height)+ ", Background = " + '{:.4f}'.format(fit.background)
+        log.info("Fitted R1 and R2 peaks with " + fit.profile + " lines, obtained following fit parameters: " + output)
+        mesh = np.linspace(fit.window[0],fit.window[1],200)
         if len(self.plot.listDataItems()) > 1:
             log.info("Removing old fit")
             self.plot.removeItem(self.plot.listDataItems()[1])
         self.plot.addItem(pg.PlotDataItem(x=mesh,y=fit_fn(mesh),symbol=None,pen=pg.mkPen(color=(0,102,255),width=2)))
 
-        labels = "p = " + '{:.4f}'.format(p) + " kbar<br/>[" + '{:.4f}'.format(ppos) + ", " + '{:.4f}'.format(pneg) + "] kbar" + "<br/>Peak = " + '{:.4f}'.format(popt[0]) + " nm<br/>Width = " + '{:.4f}'.format(popt[1])+ "<br/>Height = " + '{:.4f}'.format(popt[2])+ "<br/>Background = " + '{:.4f}'.format(popt[3])
+        labels = "p = " + '{:.4f}'.format(p) + " kbar<br/>[" + '{:.4f}'.format(ppos) + ", " + '{:.4f}'.format(pneg) + "] kbar" + "<br/>Peak = " + '{:.4f}'.format(fit.peak) + " nm<br/>Width = " + '{:.4f}'.format(fit.width)+ "<br/>Height = " + '{:.4f}'.format(fit.height)+ "<br/>Background = " + '{:.4f}'.format(fit.background)
         
         if self.fitlabel is not None:
             log.info("Removing old fit label")
@@ -419,6 +424,10 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
             self.fitlabel.setParentItem(self.plot)
             self.fitlabel.anchor(itemPos=(0.5, 0.5), parentPos=(0.8, 0.3))
 
+        self.peakwidthentry.setText('{:.4f}'.format(fit.width))
+        self.peakheightentry.setText('{:.0f}'.format(fit.height))
+        self.bkgentry.setText('{:.0f}'.format(fit.background))
+
         p_out="p = " + '{:.4f}'.format(p) + " kbar"
         self.pressurelabel.setText(p_out)
 
@@ -426,14 +435,7 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         # Use peak wavelength entered in peakwaveentry and the temperature in temperatureentry
         # and the fit chosen in the drop down menu to calculate pressure
         # output pressure into text of pressurelabel
-        T = float(self.temperatureentry.text())
-        calibration = self.rubycalibration.currentText()
-        if calibration == "4.5K calibration":
-            cal = lambda x: self.calibration_with_4p5K_fit(x,T)
-        elif calibration == "300K calibration":
-            cal = lambda x: self.calibration_with_300K_fit(x,T)
-        elif calibration == "RT calibration":
-            cal = lambda x: self.RT_calibration(x)
+        cal = self.calibration()
         lambda_e = float(self.peakwaveentry.text())
 
         p=cal(lambda_e)
@@ -441,16 +443,73 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         log.info("Quick fit of peak at " + self.peakwaveentry.text() + " nm gives " + p_out)
         self.pressurelabel.setText(p_out)
 
+    def spectrometer_session(self, spec_ser_num, serial_port):
+        ### kept open between measurements, a new session is only made if the serial number or port changed
+        if self.session is not None and (self.session.serial_number, self.session.serial_port) != (spec_ser_num, serial_port):
+            self.session.close()
+            self.session = None
+        if self.session is None:
+            self.session = SpectrometerSession(spec_ser_num, serial_port, timeout=self.timeout,
+                                               idle_timeout=self.idle_timeout, delay=self.delay)
+        return self.session
+
     def write_serial_command(self):
         serial_port = self.laserentry.text()
-        serial_command = self.sercomentry.text()+"\n"
-        ser = serial.Serial(serial_port,timeout=self.timeout) # 10 second time-out
-        log.info("Communicating with laser module at serial port " + serial_port)
-        ser.write(serial_command.encode())
-        log.info("Writing to serial port " + self.sercomentry.text() + "\\n")
-        sleep(self.delay)
-        ser.close()
-        log.info("Serial port closed")
+        with self.spectrometer_session(self.specnumentry.text(), serial_port) as session:
+            session.write(self.sercomentry.text())
+            log.info("Writing to serial port " + self.sercomentry.text() + "\\n")
+
+    def toggle_live(self, checked):
+        if checked:
+            spec_ser_num = self.specnumentry.text()
+            serial_port = self.laserentry.text()
+            if spec_ser_num == '' or serial_port == '':
+                log.warning("Enter the spectrometer serial number and laser module port for live spectra")
+                self.liveButton.setChecked(False)
+                return
+            self.clear_widget()
+            self.live_curve = pg.PlotDataItem(symbol=None,pen=pg.mkPen(color=pg.intColor(0),width=2))
+            self.plot.addItem(self.live_curve)
+            self.live_count = 0
+            self.live = LiveSpectrum(self.spectrometer_session(spec_ser_num, serial_port),
+                                     float(self.inttimeentry.text()),
+                                     scans=int(self.scannumentry.text()))
+            self.live.start()
+            self.live_timer.start(self.display_interval)
+            self.measureButton.setEnabled(False)
+            self.sercomButton.setEnabled(False)
+            log.info("Live spectrum, integration time is " + self.inttimeentry.text() + " ms, averaging over the last " + self.scannumentry.text() + " scans")
+        elif self.live is not None:
+            self.live_timer.stop()
+            self.live.stop()
+            self.update_live()
+            self.live = None
+            self.measureButton.setEnabled(True)
+            self.sercomButton.setEnabled(True)
+
+    def update_live(self):
+        ### only redraw when the thread has a new spectrum
+        if self.live.error is not None:
+            self.liveButton.setChecked(False)
+            return
+        latest = self.live.latest()
+        if latest is None or latest[0] == self.live_count:
+            return
+        self.live_count, sp_l, sp_a = latest
+        sp_a = boxcar(sp_a, int(self.boxcarentry.text()))
+        ind_fit = (sp_l < float(self.maxwaveentry.text())) & (sp_l > 690) # lower bound is 690 nm
+        self.live_curve.setData(sp_l[ind_fit], sp_a[ind_fit])
+        ### pressure of every live spectrum, a failed fit just leaves the last pressure shown
+        try:
+            fit = fit_ruby(sp_l[ind_fit], sp_a[ind_fit], profile=self.peakprofile.currentText(),
+                           window=float(self.fitnumentry.text()))
+            p, ppos, pneg = ruby_pressure(fit, self.calibration())
+            self.pressurelabel.setText("p = " + '{:.4f}'.format(p) + " kbar")
+        except (ValueError, RuntimeError) as e:
+            log.debug("Live ruby fit failed: " + str(e))
+        if self.live.voltage is not None:
+            force = self.load_cell_calibration(self.live.voltage)
+            self.forcelabel.setText('F = '+ '{:.2f}'.format(force)+' kN')
 
     def meas_spec(self):
         log.info("Clearing graph")
@@ -463,60 +522,27 @@ class SpectrumPlotWidget(TabWidget, QtWidgets.QWidget):
         serial_port = self.laserentry.text()
 
         if spec_ser_num != '' and serial_port != '':
-            spectrometer = Spectrometer.from_serial_number(spec_ser_num)
-            spectrometer.integration_time_micros(inttime*1000)
-            sp_l,sp_a=spectrometer.spectrum() # just for initializing sp_l and sp_a
-            log.info("Loading spectrometer " + self.specnumentry.text() )
-            ser = serial.Serial(serial_port,timeout=self.timeout) # 10 second time-out
-            log.info("Communicating with laser module at serial port " + serial_port)
-            ser.write('LON\n'.encode())
-            log.info("Laser on")
-            sleep(self.delay)
-            ser.write('CON\n'.encode())
-            log.info("Load cell on")
-            sleep(self.delay)
-            ser.write('READ\n'.encode())
-            s=ser.read(6) # voltage in volts
-            s=s.decode()[:-2] # get rid of /r at the end
-            force = self.load_cell_calibration(float(s))
-            log.info("Load cell voltage is " + s + " volts, which is " + str(force) + " kN")
-            self.forcelabel.setText('F = '+ '{:.2f}'.format(force)+' kN')
-            sleep(self.delay)
-            ser.write('COFF\n'.encode())
-            log.info("Load cell off")            
-
-            for i in range(scannum):
-                log.info("Measuring scan " + str(i+1) + ", integration time is" + self.inttimeentry.text() + " ms, boxcar width is " + self.boxcarentry.text() + ", averaging over " + self.scannumentry.text() + " scans, maximum wavelength plotted is " + self.maxwaveentry.text())
-                if i == 1:
-                    sp_l,sp_a=spectrometer.spectrum()
-                    sp_a_boxcar = np.convolve(np.ones(2*boxcarwidth+1)/(2*boxcarwidth+1),sp_a) 
-                    sp_a_boxcar = sp_a_boxcar[boxcarwidth:(boxcarwidth+len(intensity))]
-                    # correct for points on edge that have less neighbors to average with
-                    for j in range(boxcarwidth):
-                        sp_a_boxcar[j] = sp_a_boxcar[j]*(2*boxcarwidth+1)/(boxcarwidth+1+j)
-                        sp_a_boxcar[-1-j] = sp_a_boxcar[-1-j]*(2*boxcarwidth+1)/(boxcarwidth+1+j)
-                    sp_a = sp_a_boxcar
-                else:
-                    wavelength, intensity = spectrometer.spectrum()
-                    intensity_boxcar = np.convolve(np.ones(2*boxcarwidth+1)/(2*boxcarwidth+1),intensity) 
-                    intensity_boxcar = intensity_boxcar[boxcarwidth:(boxcarwidth+len(intensity))]
-                    # correct for points on edge that have less neighbors to average with
-                    for j in range(boxcarwidth):
-                        intensity_boxcar[j] = intensity_boxcar[j]*(2*boxcarwidth+1)/(boxcarwidth+1+j)
-                        intensity_boxcar[-1-j] = intensity_boxcar[-1-j]*(2*boxcarwidth+1)/(boxcarwidth+1+j)
-                    sp_a = sp_a + intensity_boxcar
-            sp_a = sp_a/scannum
-            sleep(self.delay)
-            spectrometer.close() # close spectrometer to avoid it being occupied for other programs
-            log.info("Spectrometer closed")
-            ser.write('LOFF\n'.encode())
-            log.info("Laser off")
-            ser.close()
-            log.info("Serial port closed")
+            ### the session keeps the spectrometer and serial port open between measurements
+            with self.spectrometer_session(spec_ser_num, serial_port) as session:
+                # set before the stale scan is discarded, so it is not taken with the previous scan count
+                session.set_processing(scannum, boxcarwidth)
+                if session.set_integration_time(inttime):
+                    session.spectrum() # the first scan after changing the integration time may be stale
+                session.write('LON')
+                log.info("Laser on")
+                voltage = session.read_load_cell() # in volts
+                force = self.load_cell_calibration(voltage)
+                log.info("Load cell voltage is " + str(voltage) + " volts, which is " + str(force) + " kN")
+                self.forcelabel.setText('F = '+ '{:.2f}'.format(force)+' kN')
+
+                log.info("Measuring " + self.scannumentry.text() + " scans, integration time is " + self.inttimeentry.text() + " ms, boxcar width is " + self.boxcarentry.text() + ", maximum wavelength plotted is " + self.maxwaveentry.text())
+                sp_l, sp_a = session.averaged_spectrum(scannum, boxcarwidth)
+                session.write('LOFF')
+                log.info("Laser off")
 
         # First plot and fit the spectrum
         
-        ind_fit=[i for i in range(len(sp_l)) if sp_l[i] < peakmax and sp_l[i] > 690] # lower bound is 690 nm to avoid divergence problems below 625 nm
+        ind_fit = (sp_l < peakmax) & (sp_l > 690) # lower bound is 690 nm to avoid divergence problems below 625 nm
         sp_a_fit=sp_a[ind_fit]
         sp_l_fit=sp_l[ind_fit]
         self.plot.addItem(pg.PlotDataItem(x=sp_l_fit,y=sp_a_fit,symbol=None,pen=pg.mkPen(color=pg.intColor(0),width=2)))
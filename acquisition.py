@@ -0,0 +1,458 @@
+#
+# Helpers shared by the measurement procedures in test_GUImpv.py and GUI_lockin_spectrum.py
+# for reading the PPMS and the lock-ins into one row of data.
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time, monotonic
+import numpy as np
+from autorange import ranger_for
+from async_instruments import AsyncLockin, AsyncPPMS
+from instrument_broker import broker_for, PROCEDURE_PRIORITY
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+ELAPSED_TIME = 'Elapsed Time (s)'
+PPMS_TIME = 'PPMS time (s)'
+
+# ways InstrumentReader can read the instruments of one row
+SEQUENTIAL = 'Sequential'
+THREADED = 'Threaded'
+ASYNCIO = 'Asyncio'
+READ_MODES = [SEQUENTIAL, THREADED, ASYNCIO]
+
+
+def lockin_column(i, quantity):
+    """ Return the data column name of quantity for the i-th (0-based) lock-in. """
+    return 'Lock-In ' + str(i+1) + ' - ' + quantity
+
+
+def time_column(column):
+    """ Return the timestamp column of the instrument that measured column,
+        or Elapsed Time (s) for columns that are not from one instrument.
+    """
+    if column.startswith('Lock-In '):
+        return column.split(' - ')[0] + ' - Time (s)'
+    if column.startswith('PPMS '):
+        return PPMS_TIME
+    return ELAPSED_TIME
+
+
+def resample(data, columns, times):
+    """ Interpolate columns of data onto common times.
+
+    Each column is interpolated against its own instrument timestamps (see
+    time_column), skipping NaN rows. data can be a pandas DataFrame or a dict
+    of arrays. Returns a dict of numpy arrays with the same length as times.
+    """
+    resampled = {}
+    for column in columns:
+        t = np.asarray(data[time_column(column)], dtype=float)
+        v = np.asarray(data[column], dtype=float)
+        valid = np.isfinite(t) & np.isfinite(v)
+        if valid.any():
+            resampled[column] = np.interp(times, t[valid], v[valid])
+        else:
+            resampled[column] = np.full(len(times), np.nan)
+    return resampled
+
+
+def aligned_xy(data, x, y):
+    """ Return x and y data columns aligned in time for plotting.
+
+    If x is an elapsed time column, y is plotted against its own instrument
+    timestamps. Otherwise y is interpolated onto the timestamps at which x
+    was measured, so for example a lock-in signal can be plotted against the
+    PPMS field at the same instant rather than in the same row.
+    """
+    if x.startswith('Elapsed Time'):
+        t = np.asarray(data[time_column(y)], dtype=float)
+        if x == 'Elapsed Time (hr)':
+            t = t / 3600
+        return t, np.asarray(data[y], dtype=float)
+    if time_column(x) == time_column(y):
+        # measured by the same instrument, already aligned
+        return np.asarray(data[x], dtype=float), np.asarray(data[y], dtype=float)
+    times = np.asarray(data[time_column(x)], dtype=float)
+    return np.asarray(data[x], dtype=float), resample(data, [y], times)[y]
+
+
+class AcquisitionClock:
+    """ Common time origin of all instrument timestamps of a measurement.
+
+    All timestamps, including the PPMS snapshot times and the buffer stream
+    times, are taken with time.monotonic(), so they are not affected by changes
+    of the system time, and converted to seconds since start. start is the
+    wall clock time at the origin, for the record only.
+    """
+
+    def __init__(self):
+        self.start = time()
+        self.start_monotonic = monotonic()
+
+    def elapsed(self):
+        """ Return the seconds since start. """
+        return monotonic() - self.start_monotonic
+
+    def since_start(self, monotonic_time):
+        """ Return the seconds since start of a time.monotonic() timestamp. """
+        return monotonic_time - self.start_monotonic
+
+
+def ppms_values(state):
+    """ Return the data columns of a PPMSState, including the resistance of the bridge channels read. """
+    data = {}
+    data['PPMS temperature (K)'] = state.temperature
+    data['PPMS field (T)'] = state.field
+    for channel, resistance in state.bridges.items():
+        data['PPMS bridge channel ' + str(channel) + ' resistance (ohm)'] = resistance
+    return data
+
+
+def read_ppms(ppms, clock):
+    """ Read the PPMS snapshot into a dict of data columns, with the time of the reading.
+        ppms can be a mpvPPMS or a PPMSPoller, which returns its latest snapshot without querying the PPMS.
+    """
+    state = ppms.snapshot(chamber=False)
+    data = ppms_values(state)
+    data[PPMS_TIME] = round(clock.since_start(state.time), 3)
+    return data
+
+
+def read_lockin(lockin, ranger, i, clock, reference=False):
+    """ Advance auto-ranging of the i-th lock-in by one step and read X and Y with the model's
+        fast_read into a dict of data columns. If reference is True, the oscillator frequency and
+        amplitude are also read. The Settling column is 1 while the reading is affected by a range change
+        and the Time column is the middle of the fast_read transaction.
+    """
+    data = {}
+    # auto_sensitivity doesn't work due to weird time-out problems, so range with one step per row instead of blocking
+    data[lockin_column(i, 'Settling')] = int(ranger.step())
+    # X and Y (and frequency and amplitude) in as few transactions as the model allows
+    before = clock.elapsed()
+    values = lockin.fast_read(reference=reference)
+    data[lockin_column(i, 'Time (s)')] = round((before + clock.elapsed()) / 2, 3)
+    data.update(lockin_values(i, values, reference))
+    return data
+
+
+def lockin_values(i, values, reference=False):
+    """ Return the data columns of the values returned by fast_read of the i-th lock-in. """
+    data = {}
+    data[lockin_column(i, 'X (V)')] = values[0]
+    data[lockin_column(i, 'Y (V)')] = values[1]
+    if reference:
+        data[lockin_column(i, 'Frequency (Hz)')] = values[2]
+        data[lockin_column(i, 'Osc Amp (V)')] = values[3]
+    return data
+
+
+async def read_ppms_async(ppms, clock):
+    """ Same as read_ppms, awaiting the AsyncPPMS ppms. """
+    state = await ppms.snapshot(chamber=False)
+    data = ppms_values(state)
+    data[PPMS_TIME] = round(clock.since_start(state.time), 3)
+    return data
+
+
+async def read_lockin_async(lockin, ranger, i, clock, reference=False):
+    """ Same as read_lockin, awaiting the AsyncLockin lockin. """
+    data = {}
+    data[lockin_column(i, 'Settling')] = int(await lockin.call(ranger.step))
+    before = clock.elapsed()
+    values = await lockin.fast_read(reference=reference)
+    data[lockin_column(i, 'Time (s)')] = round((before + clock.elapsed()) / 2, 3)
+    data.update(lockin_values(i, values, reference))
+    return data
+
+
+def read_streamed_lockin(streamer, i, clock, reference=False):
+    """ Return the data columns of the i-th lock-in from its BufferStreamer: the mean X and Y
+        of the buffer points streamed since the previous row, at their mean time.
+    """
+    data = {}
+    t, x, y, settling = streamer.take_mean()
+    data[lockin_column(i, 'Time (s)')] = round(clock.since_start(t), 3)
+    data[lockin_column(i, 'Settling')] = int(settling)
+    data[lockin_column(i, 'X (V)')] = x
+    data[lockin_column(i, 'Y (V)')] = y
+    if reference:
+        data[lockin_column(i, 'Frequency (Hz)')] = streamer.frequency
+        data[lockin_column(i, 'Osc Amp (V)')] = streamer.amplitude
+    return data
+
+
+class RingBuffer:
+    """ Fixed size buffer of rows written by one thread and taken by another.
+
+    If the reader falls behind by more than capacity rows, the oldest unread
+    rows are overwritten and counted in dropped.
+
+    :param capacity: number of rows kept
+    :param columns: number of columns per row
+    """
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.data = np.full((capacity, columns), np.nan)
+        self.written = 0 # total rows ever written
+        self.taken = 0 # total rows written before the last take
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def extend(self, rows):
+        """ Append a 2D array of rows. """
+        with self.lock:
+            if len(rows) > self.capacity:
+                self.written += len(rows) - self.capacity
+                rows = rows[-self.capacity:]
+            start = self.written % self.capacity
+            first = min(len(rows), self.capacity - start)
+            self.data[start:start + first] = rows[:first]
+            self.data[:len(rows) - first] = rows[first:]
+            self.written += len(rows)
+
+    def take(self):
+        """ Return a copy of the rows written since the last take, oldest first. """
+        with self.lock:
+            unread = self.written - self.taken
+            if unread > self.capacity:
+                self.dropped += unread - self.capacity
+                unread = self.capacity
+            rows = self.data[np.arange(self.written - unread, self.written) % self.capacity]
+            self.taken = self.written
+        return rows
+
+    def last(self):
+        """ Return a copy of all rows kept, oldest first, without taking them. """
+        with self.lock:
+            kept = min(self.written, self.capacity)
+            return self.data[np.arange(self.written - kept, self.written) % self.capacity]
+
+
+class BufferStreamer(threading.Thread):
+    """ Drains the buffer of a lock-in with its stream_buffer generator on a background thread.
+
+    Every chunk is appended to a stream file with one line per buffer point, so the
+    full rate data is kept (800 Hz for the 72XX, 512 Hz for the SR830), and to a
+    ring buffer from which each procedure row takes the mean X and Y of the points
+    streamed since the previous row. Auto-ranging (and reading the oscillator when
+    reference is True) is done at the chunk boundaries, as the lock-in must not be
+    queried from two threads at once, so each chunk is recorded at one sensitivity
+    and flagged with the settling state it was recorded in. The lock of the lock-in's
+    InstrumentBroker is only held while stream_buffer talks to the lock-in, not
+    while a chunk is being recorded.
+
+    :param lockin: DSP72XX_ar or SR830_ar instrument
+    :param ranger: AutoRanger of the lock-in
+    :param filename: stream file to write
+    :param reference: also read oscillator frequency and amplitude after each chunk
+    :param ring_size: number of buffer points kept for the procedure rows
+    :param stream_kwargs: passed on to the lock-in's stream_buffer
+    """
+
+    def __init__(self, lockin, ranger, filename, reference=False, ring_size=65536, **stream_kwargs):
+        super().__init__(name='buffer-streamer', daemon=True)
+        self.lockin = lockin
+        self.broker = broker_for(lockin)
+        self.ranger = ranger
+        self.filename = filename
+        self.reference = reference
+        self.stream_kwargs = stream_kwargs
+        self.ring = RingBuffer(ring_size, 4) # time, X, Y, settling
+        self.frequency = np.nan
+        self.amplitude = np.nan
+        self.error = None
+        self.stop_event = threading.Event()
+        self.chunk_settling = False # settling state the last chunk was recorded in
+
+    def chunk_done(self):
+        """ Called by stream_buffer with the broker lock held, between two chunks. """
+        self.chunk_settling = self.ranger.settling
+        self.ranger.step()
+        if self.reference:
+            self.frequency, self.amplitude = self.lockin.fast_read(reference=True)[2:]
+
+    def run(self):
+        # the broker lock keeps control tab requests off the bus while stream_buffer uses it
+        stream = self.lockin.stream_buffer(lock=self.broker.lock, chunk_done=self.chunk_done,
+                                           **self.stream_kwargs)
+        self.ranger.streamed = True
+        try:
+            with open(self.filename, 'w') as f:
+                f.write('Time (s),X (V),Y (V),Settling\n')
+                while not self.stop_event.is_set():
+                    times, chunk = next(stream)
+                    rows = np.column_stack((times, chunk['x'], chunk['y'],
+                                            np.full(len(times), int(self.chunk_settling))))
+                    np.savetxt(f, rows, delimiter=',', fmt=['%.5f', '%.6e', '%.6e', '%d'])
+                    self.ring.extend(rows)
+        except Exception as e:
+            log.exception("Streaming the buffer of %s failed" % self.lockin.name)
+            self.error = e
+        finally:
+            with self.broker.lock:
+                stream.close()
+            self.ranger.streamed = False
+
+    def take_mean(self):
+        """ Return (mean time, mean X, mean Y, settling) of the points streamed since the last call.
+            Time, X and Y are NaN if no chunk has arrived since then.
+        """
+        if self.error is not None:
+            raise self.error
+        rows = self.ring.take()
+        if len(rows):
+            t, x, y = rows[:, 0:3].mean(axis=0)
+        else:
+            t, x, y = np.nan, np.nan, np.nan
+        settling = bool(rows[:, 3].any()) or self.ranger.settling
+        return t, x, y, settling
+
+    def stop(self):
+        """ Stop streaming after the current chunk and wait for the thread to finish. """
+        self.stop_event.set()
+        self.join()
+
+
+class InstrumentReader:
+    """ Reads the PPMS and a list of lock-ins into one row of data.
+
+    In THREADED mode every instrument is read on its own worker thread and the
+    results are joined into one row, so a row takes as long as the slowest
+    instrument rather than the sum of all of them. In ASYNCIO mode the same
+    overlap is reached with coroutines awaiting the AsyncLockin and AsyncPPMS
+    facades on an event loop owned by the reader, which scales to many
+    instruments on one bus. In SEQUENTIAL mode the instruments are read one
+    after another as before. Each lock-in has an AutoRanger so
+    that a lock-in changing range keeps producing rows flagged as settling
+    instead of stalling the whole row.
+
+    Every instrument reading is tagged with its own timestamp column (PPMS time (s)
+    and Lock-In N - Time (s)) in seconds since clock.start, which is also the
+    origin of Elapsed Time (s), so readings taken at different instants of a row
+    can be aligned with resample.
+
+    :param ppms: mpvPPMS instrument or PPMSPoller, None if the PPMS is not measured
+    :param lockins: list of lock-in instruments
+    :param models: list of lock-in model names, same length as lockins
+    :param reference: also read oscillator frequency and amplitude of each SR830 and 72XX
+    :param mode: one of READ_MODES
+    :param stream_file: if given, the buffer of each 72XX (at 800 Hz) and SR830 (at 512 Hz)
+        is streamed by a BufferStreamer to stream_file + ' Lock-In N stream.csv' and its
+        rows are the means of the points streamed since the previous row
+    """
+
+    def __init__(self, ppms, lockins, models, reference=False, mode=THREADED, stream_file=None):
+        self.ppms = ppms
+        self.lockins = lockins
+        self.models = models
+        self.reference = reference
+        self.mode = mode
+        self.clock = AcquisitionClock()
+        self.rangers = [ranger_for(lockin) for lockin in self.lockins]
+        # shared with the control tabs, so their requests are slotted in between reads
+        self.brokers = [broker_for(lockin) for lockin in self.lockins]
+        self.streamers = {}
+        if stream_file is not None:
+            for i in range(len(self.lockins)):
+                if self.models[i] in ('DSP72XX', 'SR830'):
+                    self.streamers[i] = BufferStreamer(self.lockins[i], self.rangers[i],
+                                                       stream_file + ' Lock-In ' + str(i+1) + ' stream.csv',
+                                                       reference=self.reference)
+                    self.streamers[i].start()
+        self.executor = None
+        self.loop = None
+        if self.mode != SEQUENTIAL:
+            # one worker per instrument so that no instrument waits for another
+            workers = len(self.lockins) + (1 if self.ppms is not None else 0)
+            self.executor = ThreadPoolExecutor(max_workers=max(workers, 1),
+                                               thread_name_prefix='instrument-reader')
+        if self.mode == ASYNCIO:
+            self.loop = asyncio.new_event_loop()
+            self.async_ppms = AsyncPPMS(self.ppms, self.executor) if self.ppms is not None else None
+            self.async_lockins = [AsyncLockin(lockin, self.executor, broker=broker)
+                                  for lockin, broker in zip(self.lockins, self.brokers)]
+
+    def tasks(self):
+        """ Return a list of (broker, function, args) reading one instrument each. The broker
+            is None for tasks that do no lock-in I/O of their own.
+        """
+        tasks = []
+        if self.ppms is not None:
+            tasks.append((None, read_ppms, (self.ppms, self.clock)))
+        for i in range(len(self.lockins)):
+            # the 52XX has no frequency and amplitude columns
+            reference = self.reference and self.models[i] != 'DSP52XX'
+            if i in self.streamers:
+                tasks.append((None, read_streamed_lockin, (self.streamers[i], i, self.clock, reference)))
+            else:
+                tasks.append((self.brokers[i], read_lockin,
+                              (self.lockins[i], self.rangers[i], i, self.clock, reference)))
+        return tasks
+
+    def submit(self, broker, function, args):
+        """ Queue one task on the lock-in's broker ahead of GUI requests, or on the executor. """
+        if broker is not None:
+            return broker.submit(function, *args, priority=PROCEDURE_PRIORITY)
+        return self.executor.submit(function, *args)
+
+    def coroutines(self):
+        """ Return a list of coroutines reading one instrument each, for ASYNCIO mode. """
+        coroutines = []
+        if self.async_ppms is not None:
+            coroutines.append(read_ppms_async(self.async_ppms, self.clock))
+        for i in range(len(self.lockins)):
+            reference = self.reference and self.models[i] != 'DSP52XX'
+            if i in self.streamers:
+                # no instrument I/O, the streamer thread reads the buffer
+                coroutines.append(asyncio.to_thread(read_streamed_lockin, self.streamers[i], i, self.clock, reference))
+            else:
+                coroutines.append(read_lockin_async(self.async_lockins[i], self.rangers[i], i, self.clock, reference))
+        return coroutines
+
+    async def read_async(self):
+        """ Await every instrument once and return the joined dict of data columns. """
+        data = {}
+        for result in await asyncio.gather(*self.coroutines()):
+            data.update(result)
+        return data
+
+    def read(self):
+        """ Read every instrument once and return the joined dict of data columns. """
+        data = {}
+        if self.mode == ASYNCIO:
+            # gather re-raises any instrument error in the procedure thread
+            data = self.loop.run_until_complete(self.read_async())
+        elif self.mode == THREADED:
+            futures = [self.submit(broker, function, args) for broker, function, args in self.tasks()]
+            # result() re-raises any instrument error in the procedure thread
+            for future in futures:
+                data.update(future.result())
+        else:
+            for broker, function, args in self.tasks():
+                if broker is not None:
+                    data.update(broker.call(function, *args, priority=PROCEDURE_PRIORITY))
+                else:
+                    data.update(function(*args))
+        return data
+
+    def shutdown(self):
+        """ Stop the worker threads, waiting for reads in progress to finish, and leave
+            no lock-in at the auto-range time constant.
+        """
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        for streamer in self.streamers.values():
+            streamer.stop()
+        # restoring the time constant is bus I/O, so it queues on the broker like the reads
+        for broker, ranger in zip(self.brokers, self.rangers):
+            broker.call(ranger.cancel, priority=PROCEDURE_PRIORITY)
@@ -0,0 +1,98 @@
+#
+# Asyncio facade over the blocking instrument drivers. The VISA and MultiPyVu calls
+# are run on an executor, so a coroutine can await several instruments at once.
+
+import asyncio
+import logging
+import threading
+from functools import partial
+from instrument_broker import PROCEDURE_PRIORITY
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class AsyncInstrument:
+    """ Awaitable access to a blocking instrument.
+
+    Every call runs on the executor while holding a per-instrument lock, so
+    calls to the same instrument never interleave on the bus while calls to
+    different instruments overlap. If a broker is given, calls are queued on
+    the instrument's InstrumentBroker instead, so they are also serialized
+    with the control tabs.
+
+    :param instrument: pymeasure instrument (or mpvPPMS) to wrap
+    :param executor: concurrent.futures executor, None for the event loop's default executor
+    :param broker: InstrumentBroker of the instrument, or None
+    :param priority: priority of the calls queued on the broker
+    """
+
+    def __init__(self, instrument, executor=None, broker=None, priority=PROCEDURE_PRIORITY):
+        self.instrument = instrument
+        self.executor = executor
+        self.broker = broker
+        self.priority = priority
+        self.lock = threading.Lock()
+
+    def _locked(self, function, *args, **kwargs):
+        with self.lock:
+            return function(*args, **kwargs)
+
+    async def call(self, function, *args, **kwargs):
+        """ Run function(*args, **kwargs) on the executor (or broker) and return its result. """
+        if self.broker is not None:
+            return await asyncio.wrap_future(self.broker.submit(function, *args, priority=self.priority, **kwargs))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(self._locked, function, *args, **kwargs))
+
+    async def get(self, name):
+        """ Read the attribute or property called name of the instrument. """
+        return await self.call(getattr, self.instrument, name)
+
+    async def set(self, name, value):
+        """ Set the attribute or property called name of the instrument. """
+        await self.call(setattr, self.instrument, name, value)
+
+
+class AsyncLockin(AsyncInstrument):
+    """ Awaitable X, Y and XY of a SR830_ar, DSP72XX_ar or DSP52XX_ar lock-in. """
+
+    async def x(self):
+        """ Measure X in volts. """
+        return await self.get('x')
+
+    async def y(self):
+        """ Measure Y in volts. """
+        return await self.get('y')
+
+    async def xy(self):
+        """ Measure [X, Y] in volts from the same instant. """
+        return await self.call(self.instrument.fast_read)
+
+    async def snap(self, *vals):
+        """ Record up to 6 values at a single instant with SNAP? on the SR830, or
+            X and Y from the same instant on the DSP lock-ins.
+        """
+        if hasattr(self.instrument, 'snap'):
+            return await self.call(self.instrument.snap, *vals)
+        return await self.xy()
+
+    async def fast_read(self, reference=False):
+        """ Read X and Y (and frequency and amplitude if reference is True) with the model's fast_read. """
+        return await self.call(self.instrument.fast_read, reference=reference)
+
+
+class AsyncPPMS(AsyncInstrument):
+    """ Awaitable temperature, field and snapshot of a mpvPPMS. """
+
+    async def snapshot(self, chamber=True):
+        """ Read the PPMSState with as few client calls as possible. """
+        return await self.call(self.instrument.snapshot, chamber=chamber)
+
+    async def temperature(self):
+        """ Read the temperature in Kelvin. """
+        return await self.get('temperature')
+
+    async def field(self):
+        """ Read the field in Tesla. """
+        return await self.get('field')
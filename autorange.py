@@ -0,0 +1,199 @@
+#
+# Auto-ranging of the lock-in sensitivity as a state machine that advances one step per call,
+# so that ranging one lock-in does not stop the other instruments from being read.
+
+import logging
+import re
+import threading
+from time import sleep, monotonic
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_rangers = {}
+_rangers_lock = threading.Lock()
+
+
+def ranger_for(lockin):
+    """ Return the AutoRanger of lockin, creating one if it has none yet, so that the
+        procedure and the control tab step the same ranger rather than fighting over
+        the sensitivity and time constant.
+    """
+    with _rangers_lock:
+        ranger = _rangers.get(id(lockin))
+        if ranger is None or ranger.lockin is not lockin:
+            ranger = AutoRanger(lockin)
+            _rangers[id(lockin)] = ranger
+        return ranger
+
+
+class AutoRangeMixin:
+    """ Sensitivity and time constant commands used by :class:`AutoRanger`.
+
+    Lock-in classes inherit this before Instrument and override the class
+    attributes below where their commands differ. The defaults are for the
+    Signal Recovery lock-ins, whose MAG query returns the magnitude with
+    10000 as full scale.
+
+    The sensitivity and time constant indices are cached, so that a range
+    decision costs a single magnitude query. The cache is only forgotten
+    when a command matching RANGE_WRITES is written, or by
+    :meth:`refresh_range_cache` if the range was changed on the front panel.
+    """
+
+    SEN_QUERY = "SEN"
+    SEN_SET = "SEN %d"
+    TC_QUERY = "TC"
+    TC_SET = "TC %d"
+    MAG_QUERY = "MAG"
+    SEN_INDEX_LIMITS = (0, 15) # lowest and highest sensitivity index
+    AUTO_RANGE_TC = 4 # time constant index of 0.1s used to capture the quick change while ranging
+    AUTO_RANGE_SETTLE = 5 # seconds to settle after restoring the time constant
+    AUTO_RANGE_LIMITS = (0.1, 0.9) # keep magnitude between these fractions of full scale
+    AUTO_RANGE_START_LOWER = 0.1 # start ranging down below this fraction of full scale
+    RANGE_WRITES = r"(SEN|TC)\.? +\S|AS$" # writes that may change the sensitivity or time constant
+
+    _sen_index = None
+    _tc_index = None
+    last_range_fraction = None # magnitude as a fraction of full scale at the last range check
+
+    def write(self, command, **kwargs):
+        """ Write command to the instrument, forgetting the cached range if the command may change it. """
+        super().write(command, **kwargs)
+        if re.match(self.RANGE_WRITES, command.strip()):
+            self.refresh_range_cache()
+
+    def refresh_range_cache(self):
+        """ Forget the cached sensitivity and time constant, so they are queried again when next used. """
+        self._sen_index = None
+        self._tc_index = None
+
+    def range_fraction(self):
+        """ Return the signal magnitude as a fraction of the full scale sensitivity. """
+        self.last_range_fraction = abs(int(self.ask(self.MAG_QUERY))) / 10000
+        return self.last_range_fraction
+
+    @property
+    def sensitivity_index(self):
+        """ Control the sensitivity as an index into the instrument's sensitivity list. """
+        if self._sen_index is None:
+            self._sen_index = int(self.ask(self.SEN_QUERY))
+        return self._sen_index
+
+    @sensitivity_index.setter
+    def sensitivity_index(self, index):
+        self.write(self.SEN_SET % index)
+        self._sen_index = index
+
+    @property
+    def time_constant_index(self):
+        """ Control the time constant as an index into the instrument's time constant list. """
+        if self._tc_index is None:
+            self._tc_index = int(self.ask(self.TC_QUERY))
+        return self._tc_index
+
+    @time_constant_index.setter
+    def time_constant_index(self, index):
+        self.write(self.TC_SET % index)
+        self._tc_index = index
+
+    def auto_range(self):
+        """ Increase or decrease sensitivity by one step at a time until the magnitude of
+        the signal is within AUTO_RANGE_LIMITS of the sensitivity, then wait for the
+        lock-in to settle. This blocks until ranging is finished.
+        """
+        ranger = AutoRanger(self)
+        while ranger.step():
+            sleep(0.1)
+
+
+class AutoRanger:
+    """ Non-blocking auto-range of one lock-in.
+
+    Each call to :meth:`step` does at most one range check or sensitivity
+    change and returns immediately, so it can be called once per acquisition
+    cycle. While ranging, the time constant is switched to AUTO_RANGE_TC to
+    capture the quick change and the sensitivity is stepped once every
+    step_time seconds. The original time constant is then restored and the
+    lock-in is given AUTO_RANGE_SETTLE seconds to settle.
+
+    :param lockin: lock-in instrument inheriting :class:`AutoRangeMixin`
+    :param step_time: seconds to wait after a sensitivity change before checking again
+    """
+
+    IDLE = 'idle'
+    RANGING = 'ranging'
+    SETTLING = 'settling'
+
+    def __init__(self, lockin, step_time=1):
+        self.lockin = lockin
+        self.step_time = step_time
+        self.state = self.IDLE
+        self.saved_tc = None
+        self.next_time = 0
+        self.at_limit = False # out of range at the end of the sensitivity list, warned once
+        self.streamed = False # stepped by a BufferStreamer between chunks only
+
+    @property
+    def settling(self):
+        """ True while readings are affected by a range change. """
+        return self.state != self.IDLE
+
+    def step(self, now=None):
+        """ Advance auto-ranging by one step and return True if the lock-in is still
+        ranging or settling. now is a time.monotonic() time, the current one if None.
+        """
+        if now is None:
+            now = monotonic()
+        if self.state == self.IDLE:
+            upper = self.lockin.AUTO_RANGE_LIMITS[1]
+            fraction = self.lockin.range_fraction()
+            if fraction > upper or fraction < self.lockin.AUTO_RANGE_START_LOWER:
+                lowest, highest = self.lockin.SEN_INDEX_LIMITS
+                current_sen = self.lockin.sensitivity_index
+                new_sen = current_sen + 1 if fraction > upper else current_sen - 1
+                if not lowest <= new_sen <= highest:
+                    ### nothing to range to, stay idle rather than cycling the time constant
+                    if not self.at_limit:
+                        log.warning("%s cannot range beyond sensitivity index %d" % (self.lockin.name, current_sen))
+                        self.at_limit = True
+                    return self.settling
+                self.at_limit = False
+                ### need to change sensitivity, then change time constant to 0.1s to capture the quick change
+                self.saved_tc = self.lockin.time_constant_index
+                self.lockin.time_constant_index = self.lockin.AUTO_RANGE_TC
+                self.state = self.RANGING
+                self._change_sensitivity(fraction, now)
+            else:
+                self.at_limit = False
+        elif now >= self.next_time:
+            if self.state == self.RANGING:
+                self._change_sensitivity(self.lockin.range_fraction(), now)
+            elif self.state == self.SETTLING:
+                self.state = self.IDLE
+        return self.settling
+
+    def cancel(self):
+        """ Stop ranging, restoring the original time constant if it was changed. """
+        if self.state == self.RANGING:
+            self.lockin.time_constant_index = self.saved_tc
+        self.state = self.IDLE
+
+    def _change_sensitivity(self, fraction, now):
+        """ Step the sensitivity towards fraction being in range, or start settling
+        if it is in range or no further step is possible.
+        """
+        lower, upper = self.lockin.AUTO_RANGE_LIMITS
+        lowest, highest = self.lockin.SEN_INDEX_LIMITS
+        if fraction > upper or fraction < lower:
+            current_sen = self.lockin.sensitivity_index
+            new_sen = current_sen + 1 if fraction > upper else current_sen - 1
+            if lowest <= new_sen <= highest:
+                self.lockin.sensitivity_index = new_sen
+                self.next_time = now + self.step_time # give lock-in time to respond before checking again
+                return
+            log.warning("%s cannot range beyond sensitivity index %d" % (self.lockin.name, current_sen))
+        ### change back to original time constant and give lock-in time to settle before measuring
+        self.lockin.time_constant_index = self.saved_tc
+        self.state = self.SETTLING
+        self.next_time = now + self.lockin.AUTO_RANGE_SETTLE
@@ -0,0 +1,85 @@
+#
+# Write-behind buffering of the pymeasure Results file. The pymeasure Recorder writes and flushes
+# one line per emitted row, which on a synced (OneDrive) folder means constant sync activity and
+# latency spikes. Rows are grouped here and flushed once a row count or time threshold is reached.
+#
+# The live plots read the rows back from the file, so they lag by at most the flush interval.
+
+import logging
+from time import monotonic
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+MAX_ROWS = 1000 # rows written at most between two flushes
+BUFFER_SIZE = 1 << 20 # bytes, large enough that only explicit flushes reach the file
+
+
+class BatchFileHandler(logging.FileHandler):
+    """ FileHandler for the pymeasure Recorder that flushes the file every
+    max_rows rows or max_delay seconds instead of after every row.
+
+    The thresholds are checked whenever a row is written, flush() writes the
+    pending rows at once, e.g. on abort or shutdown.
+
+    :param filename: Results data file, opened for appending after the header
+    :param max_delay: seconds of rows that may be lost in a crash
+    :param max_rows: rows that may be lost in a crash
+    """
+
+    def __init__(self, filename, max_delay=1, max_rows=MAX_ROWS):
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self.pending = 0
+        self.last_flush = monotonic()
+        super().__init__(filename, mode='a')
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=BUFFER_SIZE,
+                    encoding=self.encoding, errors=self.errors)
+
+    def emit(self, record):
+        # StreamHandler.emit without the flush after every record
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+            return
+        self.pending += 1
+        if self.pending >= self.max_rows or monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """ Write the pending rows to the file. """
+        super().flush()
+        self.pending = 0
+        self.last_flush = monotonic()
+
+
+def buffer_results(procedure, max_delay=1, max_rows=MAX_ROWS):
+    """ Replace the file handlers of the pymeasure Recorder of the Worker running
+    procedure by BatchFileHandlers, and return them.
+
+    Call from Procedure.startup, by then the Worker has started its Recorder and
+    routed procedure.emit to itself. With max_delay <= 0 every row is flushed as
+    before and nothing is replaced.
+
+    :param procedure: running pymeasure Procedure
+    :param max_delay: seconds between flushes
+    :param max_rows: rows between flushes
+    """
+    recorder = getattr(getattr(procedure.emit, '__self__', None), 'recorder', None)
+    if recorder is None or max_delay <= 0:
+        return []
+    handlers = []
+    for handler in recorder.handlers:
+        if type(handler) is logging.FileHandler:
+            batch_handler = BatchFileHandler(handler.baseFilename, max_delay, max_rows)
+            batch_handler.setFormatter(handler.formatter)
+            batch_handler.setLevel(handler.level)
+            handler.close()
+            handler = batch_handler
+        handlers.append(handler)
+    recorder.handlers = tuple(handlers)
+    log.info("Results file flushed every %g s or %d rows" % (max_delay, max_rows))
+    return [handler for handler in handlers if isinstance(handler, BatchFileHandler)]
@@ -0,0 +1,182 @@
+#
+# Binary columnar data files written alongside the pymeasure .txt Results. The .txt file keeps
+# feeding the live plots, while analysis loads the binary file without reparsing any text.
+#
+# Two formats are supported:
+#   NUMPY: a directory <name>.cols holding meta.json and one raw little-endian float64 file per
+#          column, loaded back as np.memmap so even multi-day runs open instantly
+#   HDF5:  a file <name>.h5 with one chunked, resizable dataset per column, needs h5py
+
+import json
+import logging
+import os
+import numpy as np
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+NO_BINARY = 'None'
+NUMPY = 'NumPy columns'
+HDF5 = 'HDF5'
+DATA_FORMATS = [NO_BINARY, NUMPY, HDF5]
+
+DTYPE = np.dtype('<f8')
+META_FILE = 'meta.json'
+COLUMNS_ATTR = '_columns' # HDF5 file attribute holding the column order
+
+
+def column_file(index):
+    """ Return the file name of column number index in a NUMPY directory. """
+    return '%03d.f8' % index
+
+
+class ColumnarWriter:
+    """ Appends rows of data columns to a NUMPY directory.
+
+    Rows are collected in a chunk of chunk_rows rows and each column is appended
+    to its own file when the chunk is full, on flush and on close. Values missing
+    from a row are stored as NaN.
+
+    :param filename: directory to write, normally ending in .cols
+    :param columns: list of column names, e.g. Procedure.DATA_COLUMNS
+    :param metadata: dict of JSON-serializable procedure parameters, saved in meta.json
+    :param chunk_rows: number of rows appended to the column files at once
+    """
+
+    def __init__(self, filename, columns, metadata=None, chunk_rows=1024):
+        self.filename = filename
+        self.columns = list(columns)
+        self.metadata = metadata if metadata is not None else {}
+        self.chunk = np.full((chunk_rows, len(self.columns)), np.nan, dtype=DTYPE)
+        self.pending = 0
+        self.rows = 0
+        os.makedirs(filename, exist_ok=True)
+        self.files = [open(os.path.join(filename, column_file(i)), 'wb') for i in range(len(self.columns))]
+        self.write_meta()
+
+    def write_meta(self):
+        meta = {'columns': self.columns, 'dtype': DTYPE.str, 'rows': self.rows,
+                'metadata': self.metadata}
+        # replace atomically, so a reader never sees half a file
+        path = os.path.join(self.filename, META_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1, default=str)
+        os.replace(path + '.tmp', path)
+
+    def append(self, data):
+        """ Append one row given as a dict of column name to value. """
+        row = self.chunk[self.pending]
+        row[:] = np.nan
+        for i, column in enumerate(self.columns):
+            if column in data:
+                row[i] = data[column]
+        self.pending += 1
+        if self.pending == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        """ Append the rows collected so far to the column files. """
+        if self.pending == 0:
+            return
+        for i, f in enumerate(self.files):
+            self.chunk[:self.pending, i].tofile(f)
+            f.flush()
+        self.rows += self.pending
+        self.pending = 0
+        self.write_meta()
+
+    def close(self):
+        """ Flush the remaining rows and close the column files. """
+        self.flush()
+        for f in self.files:
+            f.close()
+
+
+class HDF5Writer(ColumnarWriter):
+    """ Appends rows of data columns to an HDF5 file, with the same interface as
+    ColumnarWriter. Every column is a chunked dataset of chunk_rows rows that grows
+    on flush, the metadata are stored as attributes of the file.
+    """
+
+    def __init__(self, filename, columns, metadata=None, chunk_rows=1024):
+        if h5py is None:
+            raise ImportError("h5py is needed for the HDF5 data format")
+        self.filename = filename
+        self.columns = list(columns)
+        self.metadata = metadata if metadata is not None else {}
+        self.chunk = np.full((chunk_rows, len(self.columns)), np.nan, dtype=DTYPE)
+        self.pending = 0
+        self.rows = 0
+        self.file = h5py.File(filename, 'w')
+        for key, value in self.metadata.items():
+            self.file.attrs[key] = value if isinstance(value, (int, float, bool, str)) else str(value)
+        # HDF5 lists datasets alphabetically, so the column order is kept as well
+        self.file.attrs[COLUMNS_ATTR] = self.columns
+        self.datasets = [self.file.create_dataset(column, shape=(0,), maxshape=(None,), dtype=DTYPE,
+                                                  chunks=(chunk_rows,))
+                         for column in self.columns]
+
+    def flush(self):
+        """ Append the rows collected so far to the datasets. """
+        if self.pending == 0:
+            return
+        for i, dataset in enumerate(self.datasets):
+            dataset.resize((self.rows + self.pending,))
+            dataset[self.rows:] = self.chunk[:self.pending, i]
+        self.rows += self.pending
+        self.pending = 0
+        self.file.flush()
+
+    def close(self):
+        """ Flush the remaining rows and close the file. """
+        self.flush()
+        self.file.close()
+
+
+def binary_filename(filename, data_format):
+    """ Return the name of the binary file kept next to the .txt data file filename. """
+    base = filename[:-4] if filename.endswith('.txt') else filename
+    return base + ('.h5' if data_format == HDF5 else '.cols')
+
+
+def open_writer(filename, columns, metadata=None, data_format=NUMPY, **kwargs):
+    """ Return a writer of data_format for the .txt data file filename, None for NO_BINARY. """
+    if data_format == NO_BINARY:
+        return None
+    writer_class = HDF5Writer if data_format == HDF5 else ColumnarWriter
+    return writer_class(binary_filename(filename, data_format), columns, metadata, **kwargs)
+
+
+def load_columns(filename):
+    """ Load a binary data file and return (columns, metadata).
+
+    columns is a dict of column name to array, memory-mapped for the NUMPY format so
+    only the parts used are read from disk. The rows still present in a writer's
+    chunk are not in the file yet.
+
+    :param filename: .cols directory or .h5 file
+    """
+    if filename.endswith('.h5'):
+        if h5py is None:
+            raise ImportError("h5py is needed to load HDF5 data files")
+        with h5py.File(filename, 'r') as f:
+            metadata = dict(f.attrs)
+            names = metadata.pop(COLUMNS_ATTR, None)
+            names = list(f.keys()) if names is None else [str(name) for name in names]
+            return {name: f[name][()] for name in names}, metadata
+    with open(os.path.join(filename, META_FILE)) as f:
+        meta = json.load(f)
+    dtype = np.dtype(meta['dtype'])
+    columns = {}
+    for i, column in enumerate(meta['columns']):
+        path = os.path.join(filename, column_file(i))
+        # from the file size rather than meta.json, which lags behind after a crash
+        rows = os.path.getsize(path) // dtype.itemsize
+        columns[column] = np.memmap(path, dtype=dtype, mode='r', shape=(rows,)) if rows else np.empty(0, dtype)
+    # columns may differ by a row if the writer stopped during a flush
+    rows = min((len(c) for c in columns.values()), default=0)
+    return {name: c[:rows] for name, c in columns.items()}, meta['metadata']
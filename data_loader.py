@@ -0,0 +1,168 @@
+#
+# Fast loading of RanView data files: the pymeasure .txt measurement files and the SpectraSuite
+# style spectrum files. Each file is read once, the header is parsed from the same text and the
+# numeric block is parsed with np.fromstring. The arrays are cached in a .npz sidecar next to the
+# file, keyed on its modification time and size, so reloading unchanged files skips parsing.
+
+import glob
+import logging
+import os
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+SPECTRUM_HEADER_LINES = 17 # SpectraSuite format, also written by SpectrumPlotWidget
+SIDECAR_SUFFIX = '.npz'
+
+
+def sidecar_filename(filename):
+    """ Return the name of the cache file of filename. """
+    return filename + SIDECAR_SUFFIX
+
+
+def _stamp(filename):
+    stat = os.stat(filename)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def _load_sidecar(filename):
+    """ Return the cached arrays of filename, or None if there are none or the file has changed since. """
+    try:
+        with np.load(sidecar_filename(filename)) as cache:
+            if np.array_equal(cache['stamp'], _stamp(filename)):
+                return {key: cache[key] for key in cache.files}
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def _save_sidecar(filename, stamp, arrays):
+    try:
+        np.savez(sidecar_filename(filename), stamp=stamp, **arrays)
+    except OSError as e:
+        # e.g. a read-only folder, loading still works without the cache
+        log.debug("Could not cache " + filename + ": " + str(e))
+
+
+def _is_numeric(line):
+    return line.strip()[:1] in ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '-', '+', '.', 'n', 'N')
+
+
+def parse_block(lines, sep):
+    """ Parse lines of numbers separated by sep (' ' for any whitespace) into a 2D array. """
+    columns = len(lines[0].split(None if sep == ' ' else sep)) if lines else 0
+    text = '\n'.join(lines) if sep == ' ' else sep.join(lines)
+    values = np.fromstring(text, sep=sep)
+    if columns == 0 or values.size != columns * len(lines):
+        # ragged or unusual rows, let loadtxt report them
+        return np.loadtxt(lines, delimiter=None if sep == ' ' else sep, ndmin=2)
+    return values.reshape(len(lines), columns)
+
+
+def load_data(filename, cache=True):
+    """ Load a pymeasure .txt data file and return (columns, parameters).
+
+    columns is a dict of data column name to array and parameters a dict of the
+    procedure parameters from the header, as strings.
+
+    :param filename: data file written by the measurement GUI
+    :param cache: use and update the .npz sidecar
+    """
+    cached = _load_sidecar(filename) if cache else None
+    if cached is not None:
+        # tolist gives str rather than np.str_, as an uncached parse does
+        names = cached['names'].tolist()
+        parameters = dict(zip(cached['parameter_names'].tolist(), cached['parameter_values'].tolist()))
+        return {name: cached['data'][:, i] for i, name in enumerate(names)}, parameters
+
+    # taken before reading, so a file still being written is parsed again next time
+    stamp = _stamp(filename)
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    parameters = {}
+    start = 0
+    while start < len(lines) and lines[start].startswith('#'):
+        # parameter lines look like "#\tName: value"
+        key, colon, value = lines[start].lstrip('#').strip().partition(':')
+        if colon and lines[start].startswith('#\t'):
+            parameters[key.strip()] = value.strip()
+        start += 1
+    names = lines[start].split(',')
+    rows = [line for line in lines[start+1:] if line.strip()]
+    data = parse_block(rows, ',') if rows else np.empty((0, len(names)))
+    if cache:
+        _save_sidecar(filename, stamp, {'names': np.array(names), 'data': data,
+                                           'parameter_names': np.array(list(parameters.keys()), dtype=str),
+                                           'parameter_values': np.array(list(parameters.values()), dtype=str)})
+    return {name: data[:, i] for i, name in enumerate(names)}, parameters
+
+
+def load_spectrum(filename, cache=True):
+    """ Load a spectrum file and return (wavelength, intensity, header).
+
+    The first SPECTRUM_HEADER_LINES lines are the header, returned as a list of
+    strings, and any non-numeric lines after the data such as 'end' are skipped.
+
+    :param filename: spectrum .txt file
+    :param cache: use and update the .npz sidecar
+    """
+    cached = _load_sidecar(filename) if cache else None
+    if cached is not None:
+        return cached['wavelength'], cached['intensity'], cached['header'].tolist()
+
+    # taken before reading, so a file still being written is parsed again next time
+    stamp = _stamp(filename)
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    header = lines[:SPECTRUM_HEADER_LINES]
+    rows = lines[SPECTRUM_HEADER_LINES:]
+    while rows and not _is_numeric(rows[-1]):
+        rows.pop()
+    data = parse_block(rows, ' ') if rows else np.empty((0, 2))
+    wavelength, intensity = data[:, 0], data[:, 1]
+    if cache:
+        _save_sidecar(filename, stamp, {'wavelength': wavelength, 'intensity': intensity,
+                                           'header': np.array(header, dtype=str)})
+    return wavelength, intensity, header
+
+
+class DataFileTail:
+    """ Reads the rows appended to a pymeasure .txt data file since the previous read,
+    e.g. while the measurement is still writing it.
+
+    :param filename: data file written by the measurement GUI
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.columns = None # known once the column header has been read
+        self.offset = 0
+        self.partial = '' # last line, not complete yet
+
+    def read_new(self):
+        """ Return a 2D array of the complete rows appended since the previous call. """
+        with open(self.filename) as f:
+            f.seek(self.offset)
+            text = f.read()
+            self.offset = f.tell()
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        if self.columns is None:
+            while lines and lines[0].startswith('#'):
+                lines.pop(0)
+            if not lines:
+                return np.empty((0, 0))
+            self.columns = lines.pop(0).rstrip('\r').split(',')
+        rows = [line for line in lines if line.strip()]
+        if not rows:
+            return np.empty((0, len(self.columns)))
+        return parse_block(rows, ',')
+
+
+def load_folder(directory, pattern='*.txt', loader=load_spectrum, cache=True):
+    """ Load every file matching pattern in directory with loader, e.g. load_spectrum
+        or load_data, and return a dict of filename to result.
+    """
+    return {filename: loader(filename, cache=cache)
+            for filename in sorted(glob.glob(os.path.join(directory, pattern)))}
@@ -10,13 +10,296 @@ from pyqtgraph.dockarea import Dock, DockArea
 from pyqtgraph.dockarea.Dock import DockLabel
 import pyqtgraph as pg
 
+from pymeasure.display.curves import ResultsCurve
 from pymeasure.display.widgets import PlotWidget, PlotFrame
-from pymeasure.display.Qt import QtWidgets
+from pymeasure.display.Qt import QtCore, QtWidgets
 from pymeasure.display.widgets.tab_widget import TabWidget
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from acquisition import aligned_xy, RingBuffer, ELAPSED_TIME
+from data_loader import DataFileTail, load_data
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+DEFAULT_PIXELS = 1000 # decimation width before the curve is in a view
+MIN_PIXELS = 100
+HISTORY_POINTS = 20000 # points kept of the full history loaded from disk in live-view mode
+HISTORY_POLL_TIME = 100 # ms between checks whether the history has been loaded
+
+# reads the history of live-view curves, so the GUI thread never parses the whole data file
+_history_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-loader')
+
+
+def minmax_decimate(x, y, pixels, x_range=None):
+    """ Return x and y reduced to at most about 2 * pixels points for drawing.
+
+    The data are cut into pixels bins of consecutive points and the minimum and
+    maximum of y in each bin are kept in their original order, so spikes survive
+    decimation. If x is sorted and x_range = (x_min, x_max) is given, only the
+    points in that range (and one point either side) are kept first, so the
+    work done per draw is bounded by the screen width rather than the run length.
+    """
+    if x_range is not None and len(x) > 1 and x[0] <= x[-1] and np.all(x[1:] >= x[:-1]):
+        start, stop = np.searchsorted(x, x_range)
+        x = x[max(start - 1, 0):stop + 1]
+        y = y[max(start - 1, 0):stop + 1]
+    if pixels <= 0 or len(y) // pixels < 3:
+        # already fewer points than the bins could reduce it to
+        return x, y
+    index = minmax_index(y, pixels)
+    return x[index], y[index]
+
+
+def minmax_index(y, pixels):
+    """ Return the indices of the points of y kept by :func:`minmax_decimate`, in order. """
+    size = len(y) // pixels if pixels > 0 else 0
+    if size < 3:
+        return np.arange(len(y))
+    bins = len(y) // size
+    yy = y[:bins * size].reshape(bins, size)
+    nan = np.isnan(yy)
+    lo = np.argmin(np.where(nan, np.inf, yy), axis=1)
+    hi = np.argmax(np.where(nan, -np.inf, yy), axis=1)
+    offsets = np.arange(bins) * size
+    index = np.empty(2 * bins, dtype=np.intp)
+    index[0::2] = offsets + np.minimum(lo, hi)
+    index[1::2] = offsets + np.maximum(lo, hi)
+    # the points after the last full bin are kept as they are
+    return np.concatenate((index, np.arange(bins * size, len(y))))
+
+
+class DecimatedResultsCurve(ResultsCurve):
+    """ ResultsCurve that keeps the full data but only draws the part in view,
+    decimated with :func:`minmax_decimate` to about two points per pixel.
+    The drawn points are recomputed when the view range changes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.x_data = np.empty(0)
+        self.y_data = np.empty(0)
+        self._view_key = None
+        super().__init__(*args, **kwargs)
+
+    def xy_data(self, data):
+        """ Return the x and y arrays to plot from the results data. """
+        return np.asarray(data[self.x], dtype=float), np.asarray(data[self.y], dtype=float)
+
+    def update_data(self):
+        if self.force_reload:
+            self.results.reload()
+        data = self.results.data  # get the current snapshot
+        self.x_data, self.y_data = self.xy_data(data)
+        self._view_key = None
+        self.redraw()
+
+    def redraw(self):
+        """ Draw the data in view, decimated to the width of the view in pixels. """
+        view = self.getViewBox()
+        x_range, pixels = None, DEFAULT_PIXELS
+        if view is not None:
+            pixels = max(int(view.width()), MIN_PIXELS)
+            if not view.autoRangeEnabled()[0]:
+                # with auto-range the whole curve is in view anyway
+                x_range = view.viewRange()[0]
+        key = (len(self.x_data), pixels, None if x_range is None else tuple(x_range))
+        if key == self._view_key:
+            return
+        self._view_key = key
+        self.setData(*minmax_decimate(self.x_data, self.y_data, pixels, x_range))
+
+    def viewRangeChanged(self, *args, **kwargs):
+        super().viewRangeChanged(*args, **kwargs)
+        self.redraw()
+
+
+class AlignedResultsCurve(DecimatedResultsCurve):
+    """ DecimatedResultsCurve that plots y against x at the times the instruments measured them
+    (see :func:`acquisition.aligned_xy`) rather than row by row.
+    """
+
+    def xy_data(self, data):
+        try:
+            return aligned_xy(data, self.x, self.y)
+        except KeyError:
+            # e.g. an older file without the instrument time columns, plot row by row
+            return super().xy_data(data)
+
+
+class LiveData:
+    """ The last rows of the data file of a running measurement, kept in a
+    preallocated :class:`acquisition.RingBuffer` instead of pymeasure Results.data,
+    so memory use does not grow with the length of the run.
+
+    :param filename: data file of the Results
+    :param points: number of rows kept
+    :param hours: if given, only rows from the last hours of Elapsed Time (s) are returned
+    """
+
+    def __init__(self, filename, points, hours=None):
+        self.filename = filename
+        self.points = points
+        self.hours = hours
+        self.tail = DataFileTail(filename)
+        self.ring = None
+        self.first_row = 0 # row number in the file of the first row returned by data
+
+    def update(self):
+        """ Append the rows written to the file since the last update. """
+        rows = self.tail.read_new()
+        if self.ring is None and self.tail.columns is not None:
+            self.ring = RingBuffer(self.points, len(self.tail.columns))
+        if len(rows):
+            self.ring.extend(rows)
+
+    def data(self):
+        """ Return a dict of column name to array of the rows kept. """
+        if self.ring is None:
+            return None
+        rows = self.ring.last()
+        columns = self.tail.columns
+        if self.hours is not None and len(rows) and ELAPSED_TIME in columns:
+            t = rows[:, columns.index(ELAPSED_TIME)]
+            rows = rows[t >= t[-1] - self.hours * 3600]
+        # the rows returned are the last ones of the file
+        self.first_row = self.ring.written - len(rows)
+        return {name: rows[:, i] for i, name in enumerate(columns)}
+
+
+# one LiveData per Results, shared by the curves of both docks
+_live_data = weakref.WeakKeyDictionary()
+
+
+def live_data_for(results, points, hours=None):
+    """ Return the LiveData of results, making it on first use. """
+    live = _live_data.get(results)
+    if live is None:
+        live = _live_data[results] = LiveData(results.data_filename, points, hours)
+    return live
+
+
+class LiveCurveMixin:
+    """ Live-view mode for a :class:`DecimatedResultsCurve`: the curve is drawn from
+    the :class:`LiveData` of its Results. When rows have been dropped from memory and
+    the view is moved beyond the kept data, the full history is read from the data
+    file on a worker thread, kept decimated to HISTORY_POINTS points and put in front
+    of the kept rows by row number, so any x column works, not only time. The history
+    is dropped when the view is auto-ranged again.
+    """
+
+    def __init__(self, results, *args, live_points=100000, live_hours=None, **kwargs):
+        self.live = live_data_for(results, live_points, live_hours)
+        self.live_x = np.empty(0)
+        self.live_y = np.empty(0)
+        self.live_first_row = 0 # row number in the file of the first kept point
+        self.history = None # (row numbers, x, y) of the decimated full file
+        self.history_future = None # history being loaded
+        super().__init__(results, *args, **kwargs)
+
+    def update_data(self):
+        self.live.update()
+        data = self.live.data()
+        if data is None:
+            return
+        self.live_x, self.live_y = self.xy_data(data)
+        self.live_first_row = self.live.first_row
+        self.compose()
+        self.redraw()
+
+    def compose(self):
+        """ Put the history rows older than the kept rows in front of them. """
+        x, y = self.live_x, self.live_y
+        if self.history is not None:
+            rows, history_x, history_y = self.history
+            older = rows < self.live_first_row
+            x = np.concatenate((history_x[older], x))
+            y = np.concatenate((history_y[older], y))
+        self.x_data, self.y_data = x, y
+        self._view_key = None
+
+    def viewRangeChanged(self, *args, **kwargs):
+        view = self.getViewBox()
+        if view is not None and len(self.live_x):
+            if view.autoRangeEnabled()[0]:
+                self.history_future = None
+                if self.history is not None:
+                    self.history = None
+                    self.compose()
+            elif self.history is None and self.history_future is None and self.live_first_row > 0:
+                x_min, x_max = view.viewRange()[0]
+                if x_min < np.nanmin(self.live_x) or x_max > np.nanmax(self.live_x):
+                    self.history_future = _history_loader.submit(self.load_history)
+                    QtCore.QTimer.singleShot(HISTORY_POLL_TIME, self.poll_history)
+        super().viewRangeChanged(*args, **kwargs)
+
+    def poll_history(self):
+        """ Draw the history once the worker has loaded it, checking again later until then. """
+        future = self.history_future
+        if future is None:
+            # auto-ranged again while loading
+            return
+        if not future.done():
+            QtCore.QTimer.singleShot(HISTORY_POLL_TIME, self.poll_history)
+            return
+        self.history_future = None
+        try:
+            self.history = future.result()
+        except Exception:
+            log.exception("Loading the full history of %s failed" % self.results.data_filename)
+            return
+        log.info("Loaded the full history of %s for the live view" % self.results.data_filename)
+        self.compose()
+        self.redraw()
+
+    def load_history(self):
+        """ Read the whole data file and return its row numbers, x and y decimated
+            to HISTORY_POINTS points. Runs on the history loader thread.
+        """
+        columns, parameters = load_data(self.results.data_filename, cache=False)
+        x, y = self.xy_data(columns)
+        index = minmax_index(y, HISTORY_POINTS // 2)
+        return index, x[index], y[index]
+
+
+class LiveResultsCurve(LiveCurveMixin, DecimatedResultsCurve):
+    """ DecimatedResultsCurve in live-view mode. """
+
+
+class LiveAlignedResultsCurve(LiveCurveMixin, AlignedResultsCurve):
+    """ AlignedResultsCurve in live-view mode. """
+
+
+class DecimatedPlotWidget(PlotWidget):
+    """ PlotWidget whose curves are :class:`DecimatedResultsCurve`, so long runs redraw
+    in a time bounded by the screen width.
+    """
+    curve_class = DecimatedResultsCurve
+    live_curve_class = LiveResultsCurve
+    curve_kwargs = {} # e.g. live_points and live_hours of the live-view curves
+
+    def new_curve(self, results, color=pg.intColor(0), **kwargs):
+        if 'pen' not in kwargs:
+            kwargs['pen'] = pg.mkPen(color=color, width=self.linewidth)
+        if 'antialias' not in kwargs:
+            kwargs['antialias'] = False
+        curve = self.curve_class(results,
+                                 wdg=self,
+                                 x=self.plot_frame.x_axis,
+                                 y=self.plot_frame.y_axis,
+                                 **self.curve_kwargs,
+                                 **kwargs,
+                                 )
+        curve.setSymbol(None)
+        curve.setSymbolBrush(None)
+        return curve
+
+
+class AlignedPlotWidget(DecimatedPlotWidget):
+    """ DecimatedPlotWidget whose curves are :class:`AlignedResultsCurve`. """
+    curve_class = AlignedResultsCurve
+    live_curve_class = LiveAlignedResultsCurve
+
 
 class DockWidget_2plot(TabWidget, QtWidgets.QWidget):
     """
@@ -32,6 +315,14 @@ class DockWidget_2plot(TabWidget, QtWidgets.QWidget):
         than x_axis_labels the last item in the list to match x_axis_labels length.
     :param linewidth: line width for plots in
         :class:`~pymeasure.display.widgets.plot_widget.PlotWidget`
+    :param align_timestamps: If True, use :class:`AlignedPlotWidget` so each curve is plotted
+        against the timestamps of the instruments that measured it. Default is False
+    :param decimate: If True, draw the curves with :class:`DecimatedPlotWidget`, which only
+        draws the points in view, min/max decimated to the plot width. Default is True
+    :param live_points: If given, use live-view mode: the curves keep only the last live_points
+        rows in memory, read from the data file, and the full history is loaded from the file
+        when zooming out past them (see :class:`LiveCurveMixin`). Default is None
+    :param live_hours: In live-view mode, only plot the last live_hours hours. Default is None
     :param layout_path: Directory path to save dock layout state. Default is './'
     :param layout_filename: Optional filename for dock layout file.
         Default: *current procedure class* + "_dock_layout.json"
@@ -39,7 +330,8 @@ class DockWidget_2plot(TabWidget, QtWidgets.QWidget):
     """
 
     def __init__(self, name, procedure_class, x_axis_labels=None, y_axis_labels=None, linewidth=1,
-                 layout_path='./', layout_filename='', parent=None):
+                 layout_path='./', layout_filename='', parent=None, align_timestamps=False,
+                 decimate=True, live_points=None, live_hours=None):
         super().__init__(name, parent)
 
         self.procedure_class = procedure_class
@@ -52,6 +344,12 @@ class DockWidget_2plot(TabWidget, QtWidgets.QWidget):
         self.y_axis_labels = y_axis_labels
         self.num_plots = 2 ### fixed 2 plots
         self.linewidth = linewidth
+        if align_timestamps:
+            self.plot_widget_class = AlignedPlotWidget
+        else:
+            self.plot_widget_class = DecimatedPlotWidget if decimate or live_points else PlotWidget
+        self.live_points = live_points
+        self.live_hours = live_hours
 
         self.dock_area = DockArea()
         self.docks = []
@@ -99,8 +397,12 @@ class DockWidget_2plot(TabWidget, QtWidgets.QWidget):
             dock = Dock("Dock " + str(i + 1), closable=False, size=(200, 50))
             self.dock_area.addDock(dock)
             self.plot_frames.append(
-                PlotWidget("Results Graph", self.procedure_class.DATA_COLUMNS, x_label,
-                           y_label, linewidth=self.linewidth))
+                self.plot_widget_class("Results Graph", self.procedure_class.DATA_COLUMNS, x_label,
+                                       y_label, linewidth=self.linewidth))
+            if self.live_points:
+                self.plot_frames[i].curve_class = self.plot_frames[i].live_curve_class
+                self.plot_frames[i].curve_kwargs = {'live_points': self.live_points,
+                                                    'live_hours': self.live_hours}
             self.plot_frames[i].plot_frame.plot_widget.scene().contextMenu.append(
                 self.save_dock_action())
             dock.addWidget(self.plot_frames[i])
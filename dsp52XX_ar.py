@@ -85,28 +85,3 @@ class DSP52XX_ar(DSP52XXBase):
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Additional properties
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    def auto_range(self):
-        ### increase or decrease sensitivity by one step when magnitude of signal is out of 0.1-0.9 of current sensitivity scale
-        # sensitivity = self.sensitivity
-        # if abs(self.mag) > 0.9*sensitivity:
-        #     while abs(self.mag) > 0.9*sensitivity:
-        #         self.write("SEN %d" % (int(self.ask("SEN")) + 1))
-        #         sensitivity = self.sensitivity
-        # elif abs(self.mag) < 0.1*sensitivity:
-        #     while abs(self.mag) < 0.1*sensitivity:
-        #         self.write("SEN %d" % (int(self.ask("SEN")) - 1))
-        #         sensitivity = self.sensitivity 
-        if abs(int(self.ask("MAG"))) > 9000 or abs(int(self.ask("MAG"))) < 1000:
-            while abs(int(self.ask("MAG"))) > 9000 or abs(int(self.ask("MAG"))) < 1000:
-                ### need to change sensitivity, then change time constant to 0.1s to capture the quick change
-                current_tc = int(self.ask("TC"))
-                self.write("TC 4")
-                sleep(delay)
-                current_sen = int(self.ask("SEN"))
-                if abs(int(self.ask("MAG"))) > 9000:
-                    self.write("SEN %d" % (current_sen + 1))
-                elif abs(int(self.ask("MAG"))) < 1000:
-                    self.write("SEN %d" % (current_sen - 1))
-                sleep(1) # give lock-in 1s to settle before checking again
-            self.write("TC %d" % current_tc) ### change back to original time constant
-            sleep(10) ### give lock-in 10s to settle before measuring
@@ -11,6 +11,8 @@ from pymeasure.instruments import Instrument
 from pymeasure.instruments.validators import modular_range_bidirectional
 from pymeasure.instruments.validators import strict_discrete_set,truncated_discrete_set
 from pymeasure.instruments.validators import strict_range
+from pyvisa.errors import VisaIOError
+from autorange import AutoRangeMixin
 
 # =============================================================================
 # Logging
@@ -18,14 +20,14 @@ from pymeasure.instruments.validators import strict_range
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
-delay = 0.1
+delay = 0.1 # starting delay between write and read, adapted to the instrument by wait_for
 
 # =============================================================================
 # Instrument file
 # =============================================================================
 
 
-class DSP52XXBase(Instrument):
+class DSP52XXBase(AutoRangeMixin, Instrument):
     """This is the base class for the Signal Recovery DSP 52XX lock-in
     amplifiers.
 
@@ -61,6 +63,18 @@ class DSP52XXBase(Instrument):
                   'event', 'frequency part 1', 'frequency part 2'
                   ]
 
+    # Auto-range settings used by AutoRanger, 52XX is slow so give it longer to settle
+    SEN_INDEX_LIMITS = (0, len(SENSITIVITIES) - 1)
+    AUTO_RANGE_TC = 4
+    AUTO_RANGE_SETTLE = 10
+    AUTO_RANGE_START_LOWER = 0.2
+
+    # Query pacing used by wait_for
+    STB_DATA_READY = 0x80 # status byte bit set when a reply is ready to be read
+    QUERY_DELAY_MIN = 0.005
+    QUERY_DELAY_MAX = 1.0
+    QUERY_DELAY_DECAY = 0.8 # shrink the delay by this factor after each reply read in time
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Initializer and important communication methods
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -72,10 +86,23 @@ class DSP52XXBase(Instrument):
             includeSCPI=False,
             **kwargs
         )
+        self.query_pace = delay
+        self.poll_status = True
 
     def read(self, **kwargs):
-        """Read the response and remove extra unicode character from instrument readings."""
-        return super().read(**kwargs).replace('\x00', '')
+        """Read the response and remove extra unicode character from instrument readings.
+
+        The query pace is shortened after every successful read and doubled after a
+        timeout, so it converges on how fast this instrument actually answers.
+        """
+        try:
+            reply = super().read(**kwargs)
+        except VisaIOError:
+            self.query_pace = min(max(self.query_pace, self.QUERY_DELAY_MIN) * 2, self.QUERY_DELAY_MAX)
+            log.debug("%s read failed, query pace backed off to %g s" % (self.name, self.query_pace))
+            raise
+        self.query_pace = max(self.query_pace * self.QUERY_DELAY_DECAY, self.QUERY_DELAY_MIN)
+        return reply.replace('\x00', '')
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Properties
@@ -264,10 +291,9 @@ class DSP52XXBase(Instrument):
     def sensitivity(self):
         """Control the signal's measurement sensitivity range.
 
-        Values returned are in volts.
+        Values returned are in volts. The sensitivity index is cached, see AutoRangeMixin.
         """
-        i=int(self.ask("SEN"))
-        return self.SENSITIVITIES[i]
+        return self.SENSITIVITIES[self.sensitivity_index]
 
     @sensitivity.setter
     def sensitivity(self, value):
@@ -288,7 +314,6 @@ class DSP52XXBase(Instrument):
     def x(self):
         """Measure the output signal's X channel in volts."""
         scaled = float(self.ask("X"))
-        sleep(delay)
         real = scaled*self.sensitivity/10000
         return real
     
@@ -296,7 +321,6 @@ class DSP52XXBase(Instrument):
     def y(self):
         """Measure the output signal's Y channel in volts."""
         scaled = float(self.ask("Y"))
-        sleep(delay)
         real = scaled*self.sensitivity/10000
         return real
     
@@ -308,7 +332,6 @@ class DSP52XXBase(Instrument):
         num_sep = [pos for pos, char in enumerate(scaled) if char == separator]
         scaled_x = float(scaled[:num_sep[0]])
         scaled_y = float(scaled[(num_sep[0]+1):])
-        sleep(delay)
         scale = self.sensitivity/10000
         real_x = scaled_x*scale
         real_y = scaled_y*scale
@@ -431,9 +454,40 @@ class DSP52XXBase(Instrument):
         """
         self.write("AQN")
 
-    def wait_for(self,query_delay):
-        """ Wait for some time. Used by ask before reading. This is added because no buffer is made and 52XX takes a long time to respond. """
-        sleep(0.1)
+    def fast_read(self, reference=False):
+        """ Measure X and Y in volts with a single XY query instead of separate
+        X and Y queries, so both values come from the same instant.
+
+        If reference is True, the oscillator frequency in Hz and amplitude in volts
+        are appended, i.e. [x, y, frequency, amplitude] is returned instead of [x, y].
+        """
+        data = self.xy
+        if reference:
+            data = data + [self.frequency, self.voltage]
+        return data
+
+    def wait_for(self, query_delay=None):
+        """ Wait until the reply is ready. Used by ask before reading. This is added because no buffer is made and 52XX takes a long time to respond.
+
+        On GPIB the serial poll status byte is polled and the reply is read as soon as it
+        is ready. Connections without serial poll wait for the adaptive query_pace instead.
+        An explicit query_delay is always waited in full.
+        """
+        if query_delay:
+            sleep(query_delay)
+            return
+        if self.poll_status:
+            deadline = time() + self.QUERY_DELAY_MAX
+            try:
+                while not self.adapter.connection.read_stb() & self.STB_DATA_READY:
+                    if time() > deadline:
+                        break
+                    sleep(self.QUERY_DELAY_MIN)
+                return
+            except (AttributeError, VisaIOError):
+                ### serial poll is not supported by this connection, pace by delay from now on
+                self.poll_status = False
+        sleep(self.query_pace)
 
 
     def shutdown(self):
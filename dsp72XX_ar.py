@@ -9,7 +9,9 @@ from dsp_base_ar import DSPBase
 from pymeasure.instruments import Instrument
 from pymeasure.instruments.validators import strict_range
 import logging
-from time import sleep
+from time import sleep, monotonic
+from contextlib import nullcontext
+import numpy as np
 
 # =============================================================================
 # Logging
@@ -103,36 +105,97 @@ class DSP72XX_ar(DSPBase):
         values=[-12, 12]
     )
 
-    def auto_range(self):
-        ### increase or decrease sensitivity by one step when magnitude of signal is out of 0.1-0.9 of current sensitivity scale
-        # sensitivity = self.sensitivity
-        # if abs(self.mag) > 0.9*sensitivity:
-        #     while abs(self.mag) > 0.9*sensitivity:
-        #         self.write("SEN %d" % (int(self.ask("SEN")) + 1))
-        #         sensitivity = self.sensitivity
-        # elif abs(self.mag) < 0.1*sensitivity:
-        #     while abs(self.mag) < 0.1*sensitivity:
-        #         self.write("SEN %d" % (int(self.ask("SEN")) - 1))
-        #         sensitivity = self.sensitivity
-
-        if abs(int(self.ask("MAG"))) > 9000 or abs(int(self.ask("MAG"))) < 1000:
-            while abs(int(self.ask("MAG"))) > 9000 or abs(int(self.ask("MAG"))) < 1000:
-                ### need to change sensitivity, then change time constant to 0.1s to capture the quick change
-                current_tc = int(self.ask("TC"))
-                self.write("TC 11")
-                current_sen = int(self.ask("SEN"))
-                if abs(int(self.ask("MAG"))) > 9000:
-                    self.write("SEN %d" % (current_sen + 1))
-                elif abs(int(self.ask("MAG"))) < 1000:
-                    self.write("SEN %d" % (current_sen - 1))
-                sleep(1) # give lock-in 1s to settle before checking again
-            self.write("TC %d" % current_tc) ### change back to original time constant
-            sleep(5) ### give lock-in 5s to settle before measuring
-
     def auto_sensitivity(self):
         ### overwrite parent class method
         self.write("AS")
 
+    def halt_buffer(self):
+        """Halts curve buffer acquisition started by TD."""
+        self.write("HC")
+
+    def dump_curve_binary(self, enum, out):
+        """Transfers one curve of the buffer with the binary DCB command and
+        decodes it straight into out.
+
+        :param int enum: index of the curve in CURVE_BITS
+        :param out: preallocated int16 numpy array, its length is the number of points read
+        """
+        self.write("DCB %d" % enum)
+        # two bytes per point, most significant byte first
+        out[:] = np.frombuffer(self.read_bytes(2 * len(out)), dtype='>i2')
+        return out
+
+    def stream_buffer(self, chunk_points=800, quantities=None, interval=None, chunks=None,
+                      lock=None, chunk_done=None):
+        """Acquires the curve buffer continuously and yields it in chunks while
+        acquisition continues.
+
+        The buffer is filled with chunk_points points, dumped in binary with
+        :meth:`dump_curve_binary` into preallocated arrays and immediately restarted,
+        so the only gap between chunks is the binary transfer. The chunk is then
+        converted with :meth:`buffer_to_float` while the next one is acquired.
+
+        Range changes must only be made in chunk_done, between chunks: in the 800 Hz
+        mode X and Y are scaled with the sensitivity read when the chunk is dumped.
+
+        :param int chunk_points: points per chunk, at most 32768 divided by the number of curves
+        :param list quantities: quantities to record as in :meth:`set_buffer`, ignored in the
+            800 Hz mode which only stores X and Y
+        :param float interval: time between points in s, multiple of 5 ms, or None for the
+            fastest rate of 1.25 ms (800 Hz)
+        :param int chunks: number of chunks to acquire, or None to stream until the generator is closed
+        :param lock: held around every command, but not while the chunk is being recorded
+        :param chunk_done: called with the lock held after each chunk is dumped and before
+            the next one is started, e.g. to step auto-ranging
+        :return: generator of (times, dict of float numpy arrays) for each chunk
+        """
+        lock = lock if lock is not None else nullcontext()
+        with lock:
+            if interval is None:
+                quantities = ['x', 'y']
+                self.set_buffer(chunk_points, quantities, 5e-3)
+                self.write("STR 0") ### 800 Hz, below the range allowed by curve_buffer_interval
+                point_time = 1.25e-3
+            else:
+                if quantities is None:
+                    quantities = ['x', 'y', 'sensitivity']
+                self.set_buffer(chunk_points, list(quantities), interval)
+                point_time = interval
+            bits = format(self.curve_buffer_bits, '021b')[::-1]
+        quantity_enums = [e for e, b in enumerate(bits) if b == "1"]
+        raw = {self.CURVE_BITS[e]: np.empty(chunk_points, dtype=np.int16) for e in quantity_enums}
+        poll = min(0.1, chunk_points * point_time / 10)
+
+        count = 0
+        with lock:
+            start = monotonic()
+            self.start_buffer()
+        try:
+            while chunks is None or count < chunks:
+                # most of the chunk is recorded without holding the bus
+                sleep(max(start + chunk_points * point_time - monotonic(), 0))
+                with lock:
+                    self.wait_for_buffer(delay=poll)
+                    for enum in quantity_enums:
+                        self.dump_curve_binary(enum, raw[self.CURVE_BITS[enum]])
+                    ### X and Y need the sensitivity the chunk was recorded at, which is only
+                    ### recorded when interval is given, so read it before any range change
+                    sensitivity = None if 'sensitivity' in raw else self.sensitivity
+                    if chunk_done is not None:
+                        chunk_done()
+                    times = start + point_time * np.arange(chunk_points)
+                    count += 1
+                    if chunks is None or count < chunks:
+                        self.init_curve_buffer()
+                        start = monotonic()
+                        self.start_buffer()
+                # buffer_to_float returns new arrays, so raw can be refilled by the next chunk
+                yield times, self.buffer_to_float(raw, sensitivity=sensitivity)
+        finally:
+            with lock:
+                if self.curve_buffer_status[0] == 1:
+                    self.halt_buffer()
+
     @property
     def adc3(self):
         """Measure the ADC3 input voltage."""
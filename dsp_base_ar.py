@@ -33,6 +33,7 @@ from pymeasure.instruments import Instrument
 from pymeasure.instruments.validators import modular_range_bidirectional
 from pymeasure.instruments.validators import strict_discrete_set, truncated_discrete_set
 from pymeasure.instruments.validators import strict_range
+from autorange import AutoRangeMixin
 
 # =============================================================================
 # Logging
@@ -47,7 +48,7 @@ log.addHandler(logging.NullHandler())
 # =============================================================================
 
 
-class DSPBase(Instrument):
+class DSPBase(AutoRangeMixin, Instrument):
     """This is the base class for the Signal Recovery DSP 72XX lock-in
     amplifiers.
 
@@ -88,6 +89,11 @@ class DSPBase(Instrument):
                   # Dual modes
                   'x2', 'y2', 'magnitude2', 'phase2', 'sensitivity2']
 
+    # Auto-range settings used by AutoRanger, index 0 of SENSITIVITIES is unused
+    SEN_INDEX_LIMITS = (1, len(SENSITIVITIES) - 1)
+    AUTO_RANGE_TC = 11
+    AUTO_RANGE_SETTLE = 5
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Initializer and important communication methods
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -479,6 +485,20 @@ class DSPBase(Instrument):
         """
         self.write("AQN")
 
+    def fast_read(self, reference=False):
+        """Measure X and Y in volts with a single XY. query, so both values
+        come from the same instant.
+
+        :param bool reference:
+            If True, the oscillator frequency in Hz and amplitude in volts are
+            appended, i.e. [x, y, frequency, amplitude] is returned instead of
+            [x, y].
+        """
+        data = self.xy
+        if reference:
+            data = data + [self.frequency, self.voltage]
+        return data
+
     def init_curve_buffer(self):
         """Initializes the curve storage memory and status variables. All
         record of previously taken curves is removed.
@@ -630,8 +650,18 @@ class DSPBase(Instrument):
 
         return data
 
+    @classmethod
+    def sensitivity_table(cls):
+        """Returns a lookup table from the sensitivity code stored in the curve
+        buffer to the sensitivity, i.e. SENSITIVITIES[code % 32] *
+        SEN_MULTIPLIER[code // 32], with NaN for unused codes.
+        """
+        table = np.full((len(cls.SEN_MULTIPLIER), 32), np.nan)
+        table[:, :len(cls.SENSITIVITIES)] = np.outer(cls.SEN_MULTIPLIER, cls.SENSITIVITIES)
+        return table.ravel()
+
     def buffer_to_float(self, buffer_data, sensitivity=None,
-                        sensitivity2=None, raise_error=True):
+                        sensitivity2=None, raise_error=True, out=None):
         """Converts fixed-point buffer data to floating point data.
 
         The provided data is converted as much as possible, but there are some
@@ -649,6 +679,9 @@ class DSPBase(Instrument):
         - Converting the frequency requires both 'frequency part 1' and
           'frequency part 2'.
 
+        All conversions are done on whole numpy arrays, with a lookup table
+        for the sensitivity and bit shifts for the frequency.
+
         :param dict buffer_data:
             The data to be converted. Must be in the format as returned by the
             `get_buffer` method: a dict of numpy arrays.
@@ -670,11 +703,19 @@ class DSPBase(Instrument):
             provided in buffer_data can be converted. If False, the columns
             that cannot be converted are omitted in the returned dict.
 
+        :param dict out:
+            If provided, a dict of preallocated float arrays with the same
+            length as the buffer data. Every converted key that is present in
+            out is written into that array instead of a new one, so
+            continuously drained buffers can be converted without allocating.
+
         :return: Floating-point buffer data
         :rtype: dict
         """
 
         data = {}
+        if out is None:
+            out = {}
 
         def maybe_raise(message):
             if raise_error:
@@ -686,18 +727,21 @@ class DSPBase(Instrument):
             """
             for key in keys:
                 if key in buffer_data:
-                    data[key] = buffer_data[key] * multiply_by
+                    data[key] = np.multiply(buffer_data[key], multiply_by, out=out.get(key))
 
         # Sensitivity (for both single and dual modes)
+        sensitivity_table = None
         for key in ["sensitivity", "sensitivity2"]:
             if key in buffer_data:
-                data[key] = np.array([
-                    self.SENSITIVITIES[v % 32] * self.SEN_MULTIPLIER[v // 32]
-                    for v in buffer_data[key]
-                ])
+                if sensitivity_table is None:
+                    sensitivity_table = self.sensitivity_table()
+                data[key] = np.take(sensitivity_table, np.asarray(buffer_data[key], dtype=np.intp),
+                                    out=out.get(key))
         # Try to set sensitivity values from arg or data
-        sensitivity = sensitivity or data.get('sensitivity', None)
-        sensitivity2 = sensitivity2 or data.get('sensitivity2', None)
+        if sensitivity is None:
+            sensitivity = data.get('sensitivity', None)
+        if sensitivity2 is None:
+            sensitivity2 = data.get('sensitivity2', None)
 
         if any(["x" in buffer_data,
                 "y" in buffer_data,
@@ -708,7 +752,7 @@ class DSPBase(Instrument):
                             "no sensitivity is provided, neither as argument "
                             "nor as part of the buffer_data. ")
             else:
-                convert_if_present(["x", "y", "magnitude", "noise"], sensitivity / 10000)
+                convert_if_present(["x", "y", "magnitude", "noise"], np.divide(sensitivity, 10000))
 
         # phase data (for both single and dual modes)
         convert_if_present(["phase", "phase2"], 1 / 100)
@@ -716,10 +760,10 @@ class DSPBase(Instrument):
         # frequency data from frequency part 1 and 2
         if "frequency part 1" in buffer_data or "frequency part 2" in buffer_data:
             if "frequency part 1" in buffer_data and "frequency part 2" in buffer_data:
-                data["frequency"] = np.array([
-                    int(format(v2, "016b") + format(v1, "016b"), 2) / 1000 for
-                    v1, v2 in zip(buffer_data["frequency part 1"], buffer_data["frequency part 2"])
-                ])
+                # part 2 holds the upper and part 1 the lower 16 bits of the frequency in mHz
+                part1 = np.asarray(buffer_data["frequency part 1"], dtype=np.int64) & 0xFFFF
+                part2 = np.asarray(buffer_data["frequency part 2"], dtype=np.int64) & 0xFFFF
+                data["frequency"] = np.divide((part2 << 16) | part1, 1000, out=out.get("frequency"))
             else:
                 maybe_raise("Can calculate the frequency only when both"
                             "frequency part 1 and 2 are provided.")
@@ -730,7 +774,7 @@ class DSPBase(Instrument):
 
         # adc3 (integrating converter); requires a call to adc3_time
         if "adc3" in buffer_data:
-            data["adc3"] = buffer_data["adc3"] / (50000 * self.adc3_time)
+            convert_if_present(["adc3"], 1 / (50000 * self.adc3_time))
 
         # event does not require a conversion
         convert_if_present(["event"])
@@ -744,7 +788,7 @@ class DSPBase(Instrument):
                             "sensitivity2 is provided, neither as argument nor "
                             "as part of the buffer_data. ")
             else:
-                convert_if_present(["x2", "y2", "magnitude2"], sensitivity2 / 10000)
+                convert_if_present(["x2", "y2", "magnitude2"], np.divide(sensitivity2, 10000))
 
         return data
 
@@ -0,0 +1,104 @@
+#
+# Per-instrument I/O broker. All access to one GPIB instrument from the control tabs and the
+# measurement procedure goes through a single worker thread with a priority queue, so commands
+# from different threads never interleave on the bus and procedure reads are never held up
+# behind GUI queries.
+
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+from queue import PriorityQueue
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+PROCEDURE_PRIORITY = 0
+GUI_PRIORITY = 10
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def broker_for(instrument):
+    """ Return the broker of instrument, starting one if it has none yet, so that
+        every caller of the same instrument shares the same queue.
+    """
+    with _brokers_lock:
+        broker = _brokers.get(id(instrument))
+        if broker is None or not broker.is_alive():
+            broker = InstrumentBroker(instrument)
+            broker.start()
+            _brokers[id(instrument)] = broker
+        return broker
+
+
+def stop_brokers():
+    """ Stop the brokers of all instruments. """
+    with _brokers_lock:
+        brokers = list(_brokers.values())
+        _brokers.clear()
+    for broker in brokers:
+        broker.stop()
+
+
+class InstrumentBroker(threading.Thread):
+    """ Runs every request to one instrument on one worker thread, lowest priority value first
+    and in submission order within a priority.
+
+    Procedure reads are submitted with PROCEDURE_PRIORITY and GUI requests with
+    GUI_PRIORITY, so GUI requests are slotted in between reads. Each request
+    returns a concurrent.futures.Future.
+
+    Code that must talk to the instrument directly for a while, such as a buffer
+    stream, can hold :attr:`lock`, which the worker holds while running a request.
+
+    :param instrument: pymeasure instrument to serialize access to
+    """
+
+    def __init__(self, instrument):
+        super().__init__(name='broker-' + str(getattr(instrument, 'name', instrument)), daemon=True)
+        self.instrument = instrument
+        self.queue = PriorityQueue()
+        self.lock = threading.RLock()
+        self._counter = itertools.count()
+
+    def run(self):
+        while True:
+            priority, count, job = self.queue.get()
+            if job is None:
+                break
+            future, function, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.lock:
+                    result = function(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, function, *args, priority=GUI_PRIORITY, **kwargs):
+        """ Queue function(*args, **kwargs) and return a Future of its result. """
+        future = Future()
+        self.queue.put((priority, next(self._counter), (future, function, args, kwargs)))
+        return future
+
+    def call(self, function, *args, priority=GUI_PRIORITY, **kwargs):
+        """ Queue function(*args, **kwargs) and wait for its result. """
+        return self.submit(function, *args, priority=priority, **kwargs).result()
+
+    def get(self, name, priority=GUI_PRIORITY):
+        """ Return a Future of the attribute or property called name of the instrument. """
+        return self.submit(getattr, self.instrument, name, priority=priority)
+
+    def set(self, name, value, priority=GUI_PRIORITY):
+        """ Return a Future of setting the attribute or property called name of the instrument. """
+        return self.submit(setattr, self.instrument, name, value, priority=priority)
+
+    def stop(self):
+        """ Finish the requests already queued at a higher priority, then stop the worker. """
+        # queued behind every pending request
+        self.queue.put((GUI_PRIORITY + 1, next(self._counter), None))
+        self.join()
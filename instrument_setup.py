@@ -0,0 +1,96 @@
+#
+# Concurrent instrument setup for the GUI entry scripts. Connecting to a lock-in and probing it
+# waits on the bus, so the instruments are opened on one thread each and setup takes as long as
+# the slowest instrument instead of the sum of all of them.
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pymeasure.display.Qt import QtCore, QtWidgets
+from dsp72XX_ar import DSP72XX_ar
+from sr830_ar import SR830_ar
+from dsp52XX_ar import DSP52XX_ar
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+### class and constructor keywords of each lock-in model,
+### 12000 ms timeout because the dsp52XX sometimes takes a long time to reply
+LOCKIN_CLASSES = {
+    'SR830': (SR830_ar, {}),
+    'DSP72XX': (DSP72XX_ar, {}),
+    'DSP52XX': (DSP52XX_ar, {'timeout': 12000}),
+}
+
+
+def open_lockin(model, port):
+    """ Connect to a lock-in, check that it answers and read the sensitivity and
+        time constant into the auto-range cache.
+    """
+    lockin_class, kwargs = LOCKIN_CLASSES[model]
+    lockin = lockin_class(port, **kwargs)
+    identity = lockin.id
+    lockin.sensitivity_index
+    lockin.time_constant_index
+    log.info("Connected to " + model + " on " + port + ", identity " + str(identity))
+    return lockin
+
+
+def close_lockin(lockin):
+    """ Close the VISA session of a lock-in opened with open_lockin. """
+    lockin.adapter.close()
+
+
+def run_concurrently(jobs, progress=None, poll_time=0.05):
+    """ Run every (label, function, args) or (label, function, args, close) in jobs on
+    its own thread and return their results in the order of jobs.
+
+    While waiting, progress(done, total, label) is called on the calling thread
+    every poll_time seconds, label being that of the last finished job, so a GUI
+    can keep its event loop running. If any job raised, close(result) is called
+    for every job that succeeded and has a close, so no instrument is left open,
+    and the first exception in the order of jobs is re-raised once all jobs have
+    finished.
+
+    :param jobs: list of (label, function, args) or (label, function, args, close)
+    :param progress: callable or None
+    :param poll_time: seconds between progress calls
+    """
+    if len(jobs) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix='instrument-setup') as executor:
+        futures = {executor.submit(job[1], *job[2]): job for job in jobs}
+        pending = set(futures)
+        label = ''
+        while pending:
+            finished, pending = wait(pending, timeout=poll_time, return_when=FIRST_COMPLETED)
+            for future in finished:
+                label = futures[future][0]
+                if future.exception() is not None:
+                    log.error("Setting up " + label + " failed: " + repr(future.exception()))
+            if progress is not None:
+                progress(len(jobs) - len(pending), len(jobs), label)
+    if any(future.exception() is not None for future in futures):
+        for future, job in futures.items():
+            if future.exception() is None and len(job) > 3:
+                try:
+                    job[3](future.result())
+                    log.info("Closed " + job[0])
+                except Exception as e:
+                    log.error("Closing " + job[0] + " failed: " + repr(e))
+    return [future.result() for future in futures]
+
+
+def progress_dialog(parent, total, text='Connecting to instruments...'):
+    """ Show a modal QProgressDialog and return it with a progress callback for run_concurrently. """
+    dialog = QtWidgets.QProgressDialog(text, None, 0, total, parent)
+    dialog.setWindowModality(QtCore.Qt.WindowModal)
+    dialog.setMinimumDuration(0)
+    dialog.setValue(0)
+
+    def progress(done, total, label):
+        dialog.setValue(done)
+        if label:
+            dialog.setLabelText(text + '\n' + label + ' done')
+        QtWidgets.QApplication.processEvents()
+
+    return dialog, progress
@@ -46,6 +46,13 @@ class ManagedDockWindow_2plot(ManagedWindowBase):
         of strings from the data columns of the procedure. The list length determines the number of
         plots
     :param linewidth: linewidth for the displayed curves, default is 1
+    :param align_timestamps: plot each curve against the timestamps of the instruments that
+        measured it, see :class:`DockWidget_2plot`
+    :param decimate: draw only the points in view, min/max decimated to the plot width,
+        see :class:`DockWidget_2plot`
+    :param live_points: keep only this many rows in memory for the plots (live-view mode),
+        see :class:`DockWidget_2plot`
+    :param live_hours: in live-view mode, only plot the last live_hours hours
     :param log_fmt: formatting string for the log-widget
     :param log_datefmt: formatting string for the date in the log-widget
     :param \\**kwargs: optional keyword arguments that will be passed to
@@ -53,7 +60,8 @@ class ManagedDockWindow_2plot(ManagedWindowBase):
     """
 
     def __init__(self, procedure_class, x_axis=None, y_axis=None,
-                 linewidth=1, log_fmt=None, log_datefmt=None, **kwargs):
+                 linewidth=1, align_timestamps=False, decimate=True, live_points=None, live_hours=None,
+                 log_fmt=None, log_datefmt=None, **kwargs):
 
         self.x_axis = x_axis
         self.y_axis = y_axis
@@ -81,7 +89,9 @@ class ManagedDockWindow_2plot(ManagedWindowBase):
 
         self.log_widget = LogWidget("Experiment Log", fmt=log_fmt, datefmt=log_datefmt)
         self.dock_widget = DockWidget_2plot("Dock Tab", procedure_class, self.x_axis_labels,
-                                      self.y_axis_labels, linewidth=linewidth)
+                                      self.y_axis_labels, linewidth=linewidth,
+                                      align_timestamps=align_timestamps, decimate=decimate,
+                                      live_points=live_points, live_hours=live_hours)
 
         if "widget_list" not in kwargs:
             kwargs["widget_list"] = ()
@@ -1,4 +1,4 @@
-### This widget should only be used when there is not a measurement going on because cross-talk will cause client to disconnect
+### All PPMS traffic of this widget goes through a PPMSPoller, so it can be used while a measurement reads the same poller
 import logging
 
 #from pyqtgraph.Qt import QtCore, QtWidgets
@@ -13,6 +13,7 @@ from pymeasure.display.Qt import QtCore, QtWidgets, QtGui
 #from pyqtgraph.Qt.QtWidgets import QTreeWidget, QTreeWidgetItem
 #from pyqtgraph.Qt import QtGui
 from pyqtgraph.Qt.QtCore import QObject, QThread, Signal, QThreadPool, Slot, QRunnable
+from ppms_poller import PPMSPoller
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -24,11 +25,20 @@ class mpvPPMSControlWidget(TabWidget, QtWidgets.QWidget):
     """
     sequence_commands = ['Set temperature (fast settle)','Set field driven','Set field persistent','Wait minutes']
     chamber_commands = ['Seal chamber', 'Purge and seal chamber', 'Vent and seal chamber', 'Pump continuously', 'Vent continuously', 'High Vacuum']
+    ### (callback, result) of a finished poller command, and (description, exception) of a failed one
+    command_done = QtCore.Signal(object, object)
+    command_failed = QtCore.Signal(str, object)
     
-    def __init__(self, name, instrument=None, refresh_time=1, check_interval=30, parent=None):
+    def __init__(self, name, instrument=None, refresh_time=1, check_interval=30, poller=None, parent=None):
         super().__init__(name, parent)
+        self.command_done.connect(self._deliver)
+        self.command_failed.connect(self._report)
         if instrument != None:
             self.instrument = instrument
+            ### shared poller owning the PPMS connection, make our own if none is given
+            self.poller = poller if poller is not None else PPMSPoller(instrument, interval=refresh_time)
+            if not self.poller.is_alive():
+                self.poller.start()
             self.refresh_time = refresh_time # default is 1s refresh rate
             self.check_interval = check_interval # check if a step has finished every 30 seconds
             ### Because running commands takes a long time and freeze up the GUI, we need to put it on a different thread
@@ -39,7 +49,8 @@ class mpvPPMSControlWidget(TabWidget, QtWidgets.QWidget):
     def _setup_ui(self):
         self.delay = 0.1 # delay time in sending GPIB command
 
-        self.notelabel = QtWidgets.QLabel(text='Do not use this tab when a measurement is going on, cross-talk will mess up the PPMS client and connection will be lost.')
+        self.note = 'Status is read from the PPMS poller shared with the measurement, commands wait for the poller.'
+        self.notelabel = QtWidgets.QLabel(text=self.note)
 
         self.sequencedropdown = QtWidgets.QComboBox()
         self.sequencedropdown.addItems(self.sequence_commands)
@@ -136,10 +147,10 @@ class mpvPPMSControlWidget(TabWidget, QtWidgets.QWidget):
 
         self.update_status()
 
-        ### refresh status, this cross-talks with collecting data, so we only initialize values on starting up
-        # self.timer = QtCore.QTimer(self)
-        # self.timer.timeout.connect(self.update_status)
-        # self.timer.start(int(self.refresh_time * 1e3))
+        ### refresh status from the poller cache, this causes no extra traffic to the PPMS
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.update_status)
+        self.timer.start(int(self.refresh_time * 1e3))
 
 
     def _layout(self):
@@ -300,60 +311,93 @@ class mpvPPMSControlWidget(TabWidget, QtWidgets.QWidget):
         """ Clear sequence. """
         self.sequencetree.clear()
 
+    def run_command(self, function, callback, description, *args):
+        """ Queue function(*args) on the poller thread and call callback, if given, with
+            its result on the GUI thread, so the GUI never waits for a PPMS snapshot.
+        """
+        future = self.poller.submit(function, *args)
+        future.add_done_callback(lambda f: self._finished(f, callback, description))
+        return future
+
+    def _finished(self, future, callback, description):
+        ### runs on the poller thread, the signals are queued to the GUI thread
+        exception = future.exception()
+        if exception is not None:
+            self.command_failed.emit(description, exception)
+        elif callback is not None:
+            self.command_done.emit(callback, future.result())
+
+    def _deliver(self, callback, result):
+        callback(result)
+
+    def _report(self, description, exception):
+        log.error("PPMS failed " + description + ": " + repr(exception))
+
     def set_chamber(self):
         """ Set chamber status according to chamberdropdown. """
         i = self.chamberdropdown.currentIndex()
-        self.instrument.set_chamber(i)
+        self.run_command(self.instrument.set_chamber, None, "setting the chamber", i)
 
     def set_bridge1(self):
         """ Set bridge channel 1 according to bridge1excitationentry and bridge1powerentry"""
         excitation = float(self.bridge1excitationentry.text())
         power = float(self.bridge1powerentry.text())
-        self.instrument.set_bridge(1,excitation,power)
+        self.run_command(self.instrument.set_bridge, None, "setting bridge channel 1", 1, excitation, power)
 
     def set_bridge2(self):
         """ Set bridge channel 2 according to bridge2excitationentry and bridge2powerentry"""
         excitation = float(self.bridge2excitationentry.text())
         power = float(self.bridge2powerentry.text())
-        self.instrument.set_bridge(2,excitation,power)
+        self.run_command(self.instrument.set_bridge, None, "setting bridge channel 2", 2, excitation, power)
 
     def set_bridge3(self):
         """ Set bridge channel 3 according to bridge3excitationentry and bridge3powerentry"""
         excitation = float(self.bridge3excitationentry.text())
         power = float(self.bridge3powerentry.text())
-        self.instrument.set_bridge(3,excitation,power)
+        self.run_command(self.instrument.set_bridge, None, "setting bridge channel 3", 3, excitation, power)
 
     def set_bridge4(self):
         """ Set bridge channel 4 according to bridge4excitationentry and bridge4powerentry"""
         excitation = float(self.bridge4excitationentry.text())
         power = float(self.bridge4powerentry.text())
-        self.instrument.set_bridge(4,excitation,power)
+        self.run_command(self.instrument.set_bridge, None, "setting bridge channel 4", 4, excitation, power)
 
     def meas_bridge1(self):
         """ Measure bridge channel 1 resistance in ohms. """
-        self.bridge1resistanceentry.setText(str(self.instrument.bridge1))
+        self.run_command(getattr, lambda r: self.bridge1resistanceentry.setText(str(r)), "measuring bridge channel 1", self.instrument, 'bridge1')
 
     def meas_bridge2(self):
         """ Measure bridge channel 2 resistance in ohms. """
-        self.bridge2resistanceentry.setText(str(self.instrument.bridge2))
+        self.run_command(getattr, lambda r: self.bridge2resistanceentry.setText(str(r)), "measuring bridge channel 2", self.instrument, 'bridge2')
 
     def meas_bridge3(self):
         """ Measure bridge channel 3 resistance in ohms. """
-        self.bridge3resistanceentry.setText(str(self.instrument.bridge3))
+        self.run_command(getattr, lambda r: self.bridge3resistanceentry.setText(str(r)), "measuring bridge channel 3", self.instrument, 'bridge3')
 
     def meas_bridge4(self):
         """ Measure bridge channel 4 resistance in ohms. """
-        self.bridge4resistanceentry.setText(str(self.instrument.bridge4))
+        self.run_command(getattr, lambda r: self.bridge4resistanceentry.setText(str(r)), "measuring bridge channel 4", self.instrument, 'bridge4')
 
     def update_status(self):
         """ Update entries of temperatureentry, temperaturestatusentry, 
             fieldentry, magnetstatusentry, chamberentry. 
         """
-        self.temperatureentry.setText(str(self.instrument.temperature))
-        self.temperaturestatusentry.setText(self.instrument.temperature_status)
-        self.fieldentry.setText(str(self.instrument.field))
-        self.magnetstatusentry.setText(self.instrument.magnet_status)
-        self.chamberentry.setText(self.instrument.chamber)
+        ### never wait on the GUI thread, show the poll error instead while the PPMS does not answer
+        if self.poller.error is not None:
+            self.notelabel.setText('PPMS not responding, showing the last status: ' + str(self.poller.error))
+        else:
+            self.notelabel.setText(self.note)
+        try:
+            state = self.poller.snapshot(timeout=0)
+        except RuntimeError:
+            self.temperaturestatusentry.setText('No reading')
+            self.magnetstatusentry.setText('No reading')
+            return
+        self.temperatureentry.setText(str(state.temperature))
+        self.temperaturestatusentry.setText(state.temperature_status)
+        self.fieldentry.setText(str(state.field))
+        self.magnetstatusentry.setText(state.magnet_status)
+        self.chamberentry.setText(state.chamber)
 
     def run_step(self,command,value,rate):
         """ Execute command specified by index in the sequencedropdown with floating
@@ -361,25 +405,25 @@ class mpvPPMSControlWidget(TabWidget, QtWidgets.QWidget):
         """
         self.step_finished = False
         if command == 0:
-            self.instrument.set_temperature(value,rate)
+            self.poller.command(self.instrument.set_temperature, value, rate)
             while not self.step_finished and not self.should_stop:
-                if self.instrument.temperature_status == "Stable":
+                if self.poller.snapshot(max_age=self.check_interval).temperature_status == "Stable":
                     # temperature sweep finished
                     self.step_finished = True
                     break
                 sleep(self.check_interval)
         elif command == 1:
-            self.instrument.set_field_driven(value,rate)
+            self.poller.command(self.instrument.set_field_driven, value, rate)
             while not self.step_finished and not self.should_stop:
-                if self.instrument.magnet_status == "Stable":
+                if self.poller.snapshot(max_age=self.check_interval).magnet_status == "Stable":
                     # field sweep finished
                     self.step_finished = True
                     break
                 sleep(self.check_interval)
         elif command == 2:
-            self.instrument.set_field_persistent(value,rate)
+            self.poller.command(self.instrument.set_field_persistent, value, rate)
             while not self.step_finished and not self.should_stop:
-                if self.instrument.magnet_status == "Stable":
+                if self.poller.snapshot(max_age=self.check_interval).magnet_status == "Stable":
                     # field sweep finished
                     self.step_finished = True
                     break
@@ -462,24 +506,24 @@ class mpvPPMSControlWidget(TabWidget, QtWidgets.QWidget):
             log.info("Sequence aborted after finishing.")
         elif self.sequence_commands.index(self.sequencetree.topLevelItem(self.current_step).text(0)) == 0:
             ### temperature sweep
-            current_temp = self.instrument.temperature
-            self.instrument.set_temperature(current_temp,0.1)
+            current_temp = self.poller.snapshot().temperature
+            self.run_command(self.instrument.set_temperature, None, "holding the temperature", current_temp, 0.1)
             self.sequencetree.topLevelItem(self.current_step).setBackground(0,self.stoppedbrush)
             self.sequencetree.topLevelItem(self.current_step).setBackground(1,self.stoppedbrush)
             self.sequencetree.topLevelItem(self.current_step).setBackground(2,self.stoppedbrush)
             log.info("Sequence aborted during temperature sweep.")
         elif self.sequence_commands.index(self.sequencetree.topLevelItem(self.current_step).text(0)) == 1:
             ### driven field sweep
-            current_field = self.instrument.field
-            self.instrument.set_field_driven(current_field,100)
+            current_field = self.poller.snapshot().field
+            self.run_command(self.instrument.set_field_driven, None, "holding the field", current_field, 100)
             self.sequencetree.topLevelItem(self.current_step).setBackground(0,self.stoppedbrush)
             self.sequencetree.topLevelItem(self.current_step).setBackground(1,self.stoppedbrush)
             self.sequencetree.topLevelItem(self.current_step).setBackground(2,self.stoppedbrush)
             log.info("Sequence aborted during driven field sweep.")
         elif self.sequence_commands.index(self.sequencetree.topLevelItem(self.current_step).text(0)) == 2:
             ### persistent field sweep
-            current_field = self.instrument.field
-            self.instrument.set_field_persistent(current_field,100)
+            current_field = self.poller.snapshot().field
+            self.run_command(self.instrument.set_field_persistent, None, "holding the field", current_field, 100)
             self.sequencetree.topLevelItem(self.current_step).setBackground(0,self.stoppedbrush)
             self.sequencetree.topLevelItem(self.current_step).setBackground(1,self.stoppedbrush)
             self.sequencetree.topLevelItem(self.current_step).setBackground(2,self.stoppedbrush)
@@ -4,6 +4,7 @@
 
 import re
 import time
+from collections import namedtuple
 from time import sleep
 import numpy as np
 from enum import IntFlag
@@ -13,6 +14,13 @@ from pymeasure.instruments.validators import strict_discrete_set, \
 import math
 
 
+PPMSState = namedtuple('PPMSState', ['temperature', 'temperature_status', 'field', 'magnet_status',
+                                     'chamber', 'bridges', 'time'])
+PPMSState.__doc__ = """ State of the PPMS returned by mpvPPMS.snapshot. Temperature in Kelvin, field in Tesla,
+    chamber is None if it was not read and bridges is a dict of resistance in ohms by channel.
+    time is the time.monotonic() of the reading. """
+
+
 class mpvPPMS(Instrument):
     
     delay = 0
@@ -20,6 +28,7 @@ class mpvPPMS(Instrument):
     maxfield = 9 # in Tesla
     maxfieldsweeprate = 1 # in Tesla/min
     maxtemperaturesweeprate = 10 # in K/min
+    bridge_channels = () # bridge channels read by snapshot
 
     def __init__(self, adapter, name="PPMS", client=None,
                  **kwargs):
@@ -102,25 +111,25 @@ class mpvPPMS(Instrument):
     @property
     def bridge1(self):
         """ Read bridge resistance in ohms in channel 1. """
-        r, s = self.client_object.resistivity.get_resistance(1) # s is the error which we don't return for now
+        r, s = self.client.resistivity.get_resistance(1) # s is the error which we don't return for now
         return r
     
     @property
     def bridge2(self):
         """ Read bridge resistance in ohms in channel 2. """
-        r, s = self.client_object.resistivity.get_resistance(2) # s is the error which we don't return for now
+        r, s = self.client.resistivity.get_resistance(2) # s is the error which we don't return for now
         return r
     
     @property
     def bridge3(self):
         """ Read bridge resistance in ohms in channel 3. """
-        r, s = self.client_object.resistivity.get_resistance(3) # s is the error which we don't return for now
+        r, s = self.client.resistivity.get_resistance(3) # s is the error which we don't return for now
         return r
     
     @property
     def bridge4(self):
         """ Read bridge resistance in ohms in channel 4. """
-        r, s = self.client_object.resistivity.get_resistance(4) # s is the error which we don't return for now
+        r, s = self.client.resistivity.get_resistance(4) # s is the error which we don't return for now
         return r
 
     def set_bridge(self,channel,excitation,power):
@@ -145,6 +154,20 @@ class mpvPPMS(Instrument):
         """ Get magnet status and return a string descriptor. """
         f, f_status = self.client.get_field()
         return f_status
+
+    def snapshot(self, chamber=True):
+        """ Read temperature and its status, field and magnet status, the chamber status
+            (if chamber is True) and the resistance of each channel in bridge_channels
+            with one client call each, and return them as a PPMSState.
+        """
+        t, t_status = self.client.get_temperature()
+        f, f_status = self.client.get_field()
+        chamber_status = self.client.get_chamber() if chamber else None
+        bridges = {}
+        for channel in self.bridge_channels:
+            r, s = self.client.resistivity.get_resistance(channel) # s is the error which we don't return for now
+            bridges[channel] = r
+        return PPMSState(t, t_status, f/10000, f_status, chamber_status, bridges, time.monotonic())
     
     # def abort_sequence(self):
     #     """ Abort any temperature or magetic field sequence commands. """
@@ -0,0 +1,138 @@
+#
+# Background poller that owns the mpvPPMS connection. The control tab, the sequence runner and
+# the measurement procedure read the latest PPMS state from it instead of querying MultiVu each,
+# which caused cross-talk and lost connections when they did so at the same time.
+
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+TIMEOUT = 10 # seconds snapshot waits before giving up on a new snapshot
+
+
+class PPMSPoller(threading.Thread):
+    """ Polls a mpvPPMS at a fixed rate and publishes the latest PPMSState.
+
+    Traffic to MultiVu is one snapshot per interval no matter how many readers
+    there are. Commands such as set_temperature are run with :meth:`command`,
+    which holds the same lock as the polling, so no two requests ever use the
+    client at the same time. :meth:`submit` queues a command to run on the poller
+    thread between snapshots instead of waiting for it, e.g. from a GUI thread.
+
+    :meth:`snapshot` has the same signature as mpvPPMS.snapshot, so a poller can
+    be used wherever the acquisition code expects the PPMS.
+
+    :param ppms: mpvPPMS instrument
+    :param interval: seconds between snapshots
+    :param chamber: also read the chamber status in every snapshot
+    :param timeout: seconds :meth:`snapshot` waits for a new snapshot by default
+    """
+
+    def __init__(self, ppms, interval=1, chamber=True, timeout=TIMEOUT):
+        super().__init__(name='ppms-poller', daemon=True)
+        self.ppms = ppms
+        self.interval = interval
+        self.chamber = chamber
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.updated = threading.Condition()
+        self.stop_event = threading.Event()
+        self.jobs = queue.Queue() # (future, function, args, kwargs) queued by submit
+        self.state = None
+        self.error = None # exception of the last poll, None once a poll succeeds
+        self.warned = None # stale state already warned about
+
+    def run(self):
+        next_poll = monotonic()
+        while not self.stop_event.is_set():
+            if monotonic() >= next_poll:
+                try:
+                    self.poll()
+                except Exception as e:
+                    log.exception("Polling the PPMS failed")
+                    self.error = e
+                next_poll = monotonic() + self.interval
+            # run submitted commands while waiting for the next snapshot
+            try:
+                job = self.jobs.get(timeout=max(next_poll - monotonic(), 0))
+            except queue.Empty:
+                continue
+            if job is not None:
+                self._run_job(*job)
+
+    def _run_job(self, future, function, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.command(function, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def poll(self):
+        """ Take one snapshot now and publish it. """
+        with self.lock:
+            state = self.ppms.snapshot(chamber=self.chamber)
+        with self.updated:
+            self.state = state
+            self.error = None
+            self.updated.notify_all()
+        return state
+
+    def snapshot(self, chamber=True, max_age=None, timeout=None):
+        """ Return the latest PPMSState, waiting for the first poll if there is none yet.
+
+        If no snapshot arrives within timeout seconds, e.g. because the MultiVu server
+        is down, the latest state is returned with a warning, or RuntimeError is raised
+        with the last poll error if there has never been one.
+
+        :param chamber: ignored, the chamber status is read if the poller was made with chamber=True
+        :param max_age: if given, wait for a new snapshot when the latest is older than max_age seconds
+        :param timeout: seconds to wait, the poller's timeout if None
+        """
+        wait = self.timeout if timeout is None else timeout
+        deadline = monotonic() + wait
+        with self.updated:
+            while self.is_alive() and self._stale(max_age) and monotonic() < deadline:
+                self.updated.wait(max(min(deadline - monotonic(), self.interval + 1), 0))
+            state = self.state
+            stale = self._stale(max_age)
+        if state is None:
+            if self.is_alive():
+                raise RuntimeError("No PPMS snapshot within %g s, last error: %r" % (wait, self.error))
+            # not polling, e.g. before start or after stop
+            return self.poll()
+        if stale and self.is_alive():
+            if self.warned is not state:
+                log.warning("PPMS snapshot is %.0f s old, last error: %r" % (monotonic() - state.time, self.error))
+                self.warned = state
+        return state
+
+    def _stale(self, max_age):
+        return self.state is None or (max_age is not None and monotonic() - self.state.time > max_age)
+
+    def command(self, function, *args, **kwargs):
+        """ Run function(*args, **kwargs), e.g. a mpvPPMS method, without colliding with polling. """
+        with self.lock:
+            return function(*args, **kwargs)
+
+    def submit(self, function, *args, **kwargs):
+        """ Queue function(*args, **kwargs) to run on the poller thread and return a
+            concurrent.futures.Future of its result.
+        """
+        future = Future()
+        self.jobs.put((future, function, args, kwargs))
+        return future
+
+    def stop(self):
+        """ Stop polling and wait for the thread to finish. """
+        self.stop_event.set()
+        self.jobs.put(None) # wake the thread up
+        if self.is_alive():
+            self.join()
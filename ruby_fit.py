@@ -0,0 +1,136 @@
+#
+# Fitting of the ruby R1 and R2 fluorescence lines for pressure calibration. The fit seeds itself
+# from the data (log-parabola through the top three points, second moment for the width), so no
+# hand-typed guesses are needed, and uses an analytic Jacobian, so it is fast enough to run on
+# every live spectrum.
+
+import logging
+from collections import namedtuple
+import numpy as np
+from scipy.optimize import least_squares
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+GAUSSIAN = 'Gaussian'
+LORENTZIAN = 'Lorentzian'
+PROFILES = [GAUSSIAN, LORENTZIAN]
+
+R2_SEPARATION = 1.4 # nm, R1 - R2 at ambient pressure, changes little with pressure
+R2_RATIO = 0.5 # typical R2/R1 height
+WINDOW = 5 # fit window in peak widths beyond R1 and R2
+
+# parameters: R1 position, width, R1 height, R1 - R2 separation, R2 height, background;
+# width is the standard deviation of a Gaussian or the half width at half maximum of a Lorentzian
+RubyFit = namedtuple('RubyFit', ['peak', 'peak_error', 'width', 'height', 'r2_peak', 'r2_height',
+                                 'background', 'profile', 'params', 'covariance', 'window'])
+
+
+def line_shape(x, m, s, profile):
+    """ Return the unit height line shape and its derivatives with respect to m and s. """
+    u = (x - m) / s
+    if profile == LORENTZIAN:
+        f = 1 / (1 + u * u)
+        return f, 2 * u * f * f / s, 2 * u * u * f * f / s
+    f = np.exp(-u * u / 2)
+    return f, u * f / s, u * u * f / s
+
+
+def model(x, params, profile=GAUSSIAN):
+    """ Return the R1 + R2 + background model at wavelengths x. """
+    m, s, a1, d, a2, b = params
+    return a1 * line_shape(x, m, s, profile)[0] + a2 * line_shape(x, m - d, s, profile)[0] + b
+
+
+def jacobian(x, params, profile=GAUSSIAN):
+    """ Return the analytic derivatives of :func:`model` with respect to params, one column each. """
+    m, s, a1, d, a2, b = params
+    f1, dm1, ds1 = line_shape(x, m, s, profile)
+    f2, dm2, ds2 = line_shape(x, m - d, s, profile)
+    return np.column_stack((a1 * dm1 + a2 * dm2, a1 * ds1 + a2 * ds2, f1, -a2 * dm2, f2, np.ones(len(x))))
+
+
+def seed(x, y, profile=GAUSSIAN):
+    """ Return starting params from the data: R1 from a parabola through the log of the top three
+        points above background (their centroid if that fails), width from the second moment
+        of the points above half maximum, R2 from the highest point where R2 is expected.
+    """
+    b = np.percentile(y, 10)
+    k = int(np.clip(np.argmax(y), 1, len(y) - 2))
+    dx = (x[k + 1] - x[k - 1]) / 2
+    top = y[k - 1:k + 2] - b
+    m = None
+    if np.all(top > 0):
+        l = np.log(top)
+        curvature = l[0] - 2 * l[1] + l[2]
+        if curvature < 0:
+            m = x[k] + dx * (l[0] - l[2]) / (2 * curvature)
+    if m is None or abs(m - x[k]) > abs(dx):
+        m = np.sum(x[k - 1:k + 2] * np.clip(top, 0, None)) / max(np.sum(np.clip(top, 0, None)), 1e-12)
+    a1 = y[k] - b
+    # contiguous points above half maximum around the peak
+    above = y - b > a1 / 2
+    lo, hi = k, k
+    while lo > 0 and above[lo - 1]:
+        lo -= 1
+    while hi < len(y) - 1 and above[hi + 1]:
+        hi += 1
+    w = y[lo:hi + 1] - b
+    s = np.sqrt(np.sum(w * (x[lo:hi + 1] - m) ** 2) / np.sum(w)) if hi > lo else abs(dx)
+    if profile == LORENTZIAN:
+        s = s * 1.5 # the moment of the top of a Lorentzian underestimates its half width
+    s = max(s, abs(dx))
+    r2 = (x > m - R2_SEPARATION - 3 * s) & (x < m - R2_SEPARATION + 3 * s)
+    a2 = max(np.max(y[r2]) - b, 0) if r2.any() else R2_RATIO * a1
+    return np.array([m, s, a1, R2_SEPARATION, a2, b])
+
+
+def fit_ruby(x, y, profile=GAUSSIAN, window=WINDOW):
+    """ Fit the R1 and R2 lines in a spectrum and return a RubyFit.
+
+    Only the points from window widths below R2 to window widths above R1 of the
+    seed are fitted. peak_error is the standard error of R1 from the covariance
+    scaled by the residual variance.
+
+    :param x: wavelengths in nm, increasing
+    :param y: intensities
+    :param profile: GAUSSIAN or LORENTZIAN
+    :param window: half width of the fit window in peak widths
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) < 8:
+        raise ValueError("Too few points to fit the ruby lines")
+    p0 = seed(x, y, profile)
+    lo, hi = p0[0] - p0[3] - window * p0[1], p0[0] + window * p0[1]
+    inside = (x >= lo) & (x <= hi)
+    if np.count_nonzero(inside) < 8:
+        raise ValueError("Too few points around the ruby lines")
+    xf, yf = x[inside], y[inside]
+    lower = [xf[0], 0, 0, 0.5 * R2_SEPARATION, 0, -np.inf]
+    upper = [xf[-1], xf[-1] - xf[0], np.inf, 2 * R2_SEPARATION, np.inf, np.inf]
+    p0 = np.clip(p0, lower, upper)
+    result = least_squares(lambda p: model(xf, p, profile) - yf, p0,
+                           jac=lambda p: jacobian(xf, p, profile),
+                           bounds=(lower, upper), x_scale='jac')
+    if not result.success:
+        raise RuntimeError("Ruby fit did not converge: " + result.message)
+    p = result.x
+    dof = max(len(xf) - len(p), 1)
+    J = result.jac
+    try:
+        covariance = np.linalg.inv(J.T @ J) * (2 * result.cost / dof)
+    except np.linalg.LinAlgError:
+        covariance = np.full((len(p), len(p)), np.inf)
+    return RubyFit(p[0], np.sqrt(covariance[0, 0]), p[1], p[2], p[0] - p[3], p[4], p[5],
+                   profile, p, covariance, (lo, hi))
+
+
+def ruby_pressure(fit, calibration):
+    """ Return the pressure of the R1 line and its value one standard error above and below.
+
+    :param fit: RubyFit
+    :param calibration: function of the R1 wavelength in nm returning the pressure
+    """
+    return (calibration(fit.peak), calibration(fit.peak + fit.peak_error),
+            calibration(fit.peak - fit.peak_error))
@@ -0,0 +1,283 @@
+#
+# Long-lived connection to the Ocean Optics spectrometer and the laser/load cell module. Opening
+# the spectrometer (USB enumeration) and the serial port took longer than a short integration, so
+# they are kept open between measurements and only released after being idle for a while, so that
+# other programs such as SpectraSuite can use them.
+
+import logging
+import threading
+from time import sleep, monotonic
+import numpy as np
+from spectrum_processing import acquire_scans, average_scans
+from seabreeze.spectrometers import Spectrometer
+import serial
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+IDLE_TIMEOUT = 300 # seconds without use before the devices are released
+
+
+class SpectrometerSession:
+    """ Spectrometer and laser module serial port, opened on first use and kept open.
+
+    Use :meth:`acquire` and :meth:`release` (or a with block) around each
+    measurement. Once released by every user, the devices are closed after
+    idle_timeout seconds unless acquired again. The spectrometer is only opened
+    when a spectrum or the integration time is first asked for, so serial
+    commands alone do not take the spectrometer.
+
+    :param serial_number: spectrometer serial number, e.g. USB2+H05410
+    :param serial_port: serial port of the laser module, e.g. COM9
+    :param timeout: serial read time-out in seconds
+    :param idle_timeout: seconds before idle devices are released
+    :param delay: seconds to wait after each serial command
+    """
+
+    def __init__(self, serial_number, serial_port, timeout=10, idle_timeout=IDLE_TIMEOUT, delay=0.1):
+        self.serial_number = serial_number
+        self.serial_port = serial_port
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.users = 0
+        self.timer = None
+        self.spectrometer = None
+        self.serial = None
+        self.integration_time = None # ms, last value sent to the spectrometer
+        self.processing_feature = None # on-device scan averaging and boxcar, if the model has it
+        self.processing = None # (scans, boxcar width) last sent to the spectrometer
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            if exc_type is not None:
+                # the devices may be in an unknown state, open them again next time
+                self.users -= 1
+                self.close()
+            else:
+                self.release()
+
+    def acquire(self):
+        """ Start using the devices, opening the serial port if it is not open, and return self. """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.users += 1
+            if self.serial is None:
+                self.serial = serial.Serial(self.serial_port, timeout=self.timeout)
+                log.info("Communicating with laser module at serial port " + self.serial_port)
+            return self
+
+    def release(self):
+        """ Stop using the devices, they are closed after idle_timeout seconds unless acquired again. """
+        with self.lock:
+            self.users -= 1
+            if self.users == 0:
+                self.timer = threading.Timer(self.idle_timeout, self.close_idle)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def close_idle(self):
+        with self.lock:
+            if self.users == 0:
+                log.info("Spectrometer session idle for " + str(self.idle_timeout) + " s")
+                self.close()
+
+    def close(self):
+        """ Close the spectrometer and the serial port now. """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.spectrometer is not None:
+                try:
+                    self.spectrometer.close()
+                finally:
+                    self.spectrometer = None
+                    self.integration_time = None
+                    self.processing_feature = None
+                    self.processing = None
+                log.info("Spectrometer closed")
+            if self.serial is not None:
+                try:
+                    self.serial.close()
+                finally:
+                    self.serial = None
+                log.info("Serial port closed")
+
+    def open_spectrometer(self):
+        """ Return the spectrometer, opening it if it is not open. """
+        with self.lock:
+            if self.spectrometer is None:
+                self.spectrometer = Spectrometer.from_serial_number(self.serial_number)
+                log.info("Loading spectrometer " + self.serial_number)
+                # only the cseabreeze backend and some models have it
+                features = getattr(self.spectrometer, 'features', {}).get('spectrum_processing', [])
+                self.processing_feature = features[0] if features else None
+                if self.processing_feature is not None:
+                    log.info("Spectrometer averages scans and boxcar on the device")
+            return self.spectrometer
+
+    def set_integration_time(self, inttime):
+        """ Set the integration time in ms, only sending it if it has changed.
+            Return True if it was sent.
+        """
+        spectrometer = self.open_spectrometer()
+        if inttime == self.integration_time:
+            return False
+        spectrometer.integration_time_micros(inttime*1000)
+        self.integration_time = inttime
+        return True
+
+    def set_processing(self, scans, width):
+        """ Set the scans averaged and the boxcar half width applied on the device, only
+            sending them if they have changed. Return False if the device cannot do it.
+        """
+        self.open_spectrometer()
+        if self.processing_feature is None:
+            return False
+        if (scans, width) != self.processing:
+            try:
+                self.processing_feature.set_scans_to_average(scans)
+                self.processing_feature.set_boxcar_width(width)
+            except Exception as e:
+                log.warning("On-device averaging failed, averaging on the computer: " + str(e))
+                self.reset_processing()
+                return False
+            self.processing = (scans, width)
+        return True
+
+    def reset_processing(self):
+        """ Switch on-device averaging and boxcar off and stop using them, so that the
+            host averaging that follows does not average already averaged scans.
+        """
+        feature = self.processing_feature
+        self.processing_feature = None
+        self.processing = None
+        try:
+            feature.set_scans_to_average(1)
+            feature.set_boxcar_width(0)
+        except Exception as e:
+            log.error("Could not switch on-device averaging off: " + str(e))
+
+    def spectrum(self):
+        """ Return the wavelengths and intensities of one spectrum, averaged and
+            smoothed on the device as last set with set_processing.
+        """
+        return self.open_spectrometer().spectrum()
+
+    def averaged_spectrum(self, scans, width):
+        """ Return the wavelengths and the mean intensities of scans scans, smoothed with
+            a boxcar of half width width. The device averages and smooths in a single
+            transfer if it can, otherwise every scan is read and averaged here.
+        """
+        if self.set_processing(scans, width):
+            wavelength, intensity = self.spectrum()
+            return np.asarray(wavelength, dtype=float), np.asarray(intensity, dtype=float)
+        wavelength, data = acquire_scans(self.spectrum, scans)
+        return wavelength, average_scans(data, width)
+
+    def write(self, command):
+        """ Send a command such as LON to the laser module and wait delay seconds. """
+        self.serial.write((command + '\n').encode())
+        sleep(self.delay)
+
+    def read(self, size):
+        """ Read size bytes from the laser module. """
+        return self.serial.read(size)
+
+    def read_load_cell(self):
+        """ Switch the load cell on, return its voltage in volts and switch it off again. """
+        self.write('CON')
+        self.write('READ')
+        s = self.read(6).decode()[:-2] # get rid of /r at the end
+        self.write('COFF')
+        return float(s)
+
+
+class LiveSpectrum(threading.Thread):
+    """ Acquires spectra continuously from a SpectrometerSession on a background thread.
+
+    Each scan is added to a running average over the last scans scans, which is
+    written to the back half of a double buffer that is then swapped with the
+    front half, so :meth:`latest` never sees a half written spectrum. The load
+    cell is read every force_interval seconds between scans. The laser is on
+    while the thread runs.
+
+    :param session: SpectrometerSession, acquired for as long as the thread runs
+    :param inttime: integration time in ms
+    :param scans: number of scans in the running average
+    :param force_interval: seconds between load cell readings, None to not read it
+    """
+
+    def __init__(self, session, inttime, scans=1, force_interval=1):
+        super().__init__(name='live-spectrum', daemon=True)
+        self.session = session
+        self.inttime = inttime
+        self.scans = max(scans, 1)
+        self.force_interval = force_interval
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.wavelength = None
+        self.buffers = None # double buffer of averaged spectra
+        self.front = 0
+        self.count = 0 # spectra acquired so far
+        self.voltage = None # last load cell voltage
+        self.error = None
+
+    def run(self):
+        try:
+            with self.session:
+                self.session.set_integration_time(self.inttime)
+                # single scans, the running average is done here
+                self.session.set_processing(1, 0)
+                self.session.write('LON')
+                log.info("Laser on, live spectrum started")
+                try:
+                    self.acquire()
+                finally:
+                    self.session.write('LOFF')
+                    log.info("Laser off, live spectrum stopped")
+        except Exception as e:
+            log.exception("Live spectrum failed")
+            self.error = e
+
+    def acquire(self):
+        wavelength, intensity = self.session.spectrum()
+        self.wavelength = np.asarray(wavelength, dtype=float)
+        recent = np.zeros((self.scans, len(intensity)))
+        total = np.zeros(len(intensity))
+        self.buffers = np.zeros((2, len(intensity)))
+        last_force = None
+        while not self.stop_event.is_set():
+            # running sum over the last scans spectra
+            slot = self.count % self.scans
+            total += intensity - recent[slot]
+            recent[slot] = intensity
+            back = 1 - self.front
+            np.divide(total, min(self.count + 1, self.scans), out=self.buffers[back])
+            with self.lock:
+                self.front = back
+                self.count += 1
+            if self.force_interval is not None and (last_force is None or monotonic() - last_force >= self.force_interval):
+                self.voltage = self.session.read_load_cell()
+                last_force = monotonic()
+            wavelength, intensity = self.session.spectrum()
+
+    def latest(self):
+        """ Return (count, wavelength, averaged intensity) of the newest spectrum, or None before the first. """
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.count, self.wavelength, self.buffers[self.front].copy()
+
+    def stop(self):
+        """ Stop acquiring and wait for the thread to switch the laser off. """
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
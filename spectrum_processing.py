@@ -0,0 +1,54 @@
+#
+# Smoothing and averaging of spectrometer scans. The boxcar uses a cumulative sum, so it takes the
+# same time per pixel for any width, and the pixels near the edges are averaged over the neighbours
+# they have rather than padded with zeros.
+
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def boxcar(intensity, width):
+    """ Return intensity with each pixel averaged with width pixels on either side.
+
+    Pixels closer than width to an edge are averaged over the pixels that exist,
+    e.g. the first pixel over width+1 pixels. Works along the last axis, so a
+    (scans, pixels) array is smoothed scan by scan.
+
+    :param intensity: array of intensities
+    :param width: boxcar half width in pixels, 0 for no smoothing
+    """
+    intensity = np.asarray(intensity, dtype=float)
+    if width <= 0:
+        return intensity.copy()
+    pixels = intensity.shape[-1]
+    total = np.zeros(intensity.shape[:-1] + (pixels + 1,))
+    np.cumsum(intensity, axis=-1, out=total[..., 1:])
+    i = np.arange(pixels)
+    lo = np.maximum(i - width, 0)
+    hi = np.minimum(i + width + 1, pixels)
+    return (total[..., hi] - total[..., lo]) / (hi - lo)
+
+
+def acquire_scans(spectrum, scans):
+    """ Take scans spectra into a preallocated (scans, pixels) array.
+
+    :param spectrum: function returning (wavelength, intensity), e.g. SpectrometerSession.spectrum
+    :param scans: number of scans
+    :return: wavelength and the (scans, pixels) array of intensities
+    """
+    wavelength, intensity = spectrum()
+    data = np.empty((scans, len(intensity)))
+    data[0] = intensity
+    for i in range(1, scans):
+        data[i] = spectrum()[1]
+    return np.asarray(wavelength, dtype=float), data
+
+
+def average_scans(data, width=0):
+    """ Return the mean of a (scans, pixels) array of scans, smoothed with a boxcar of
+        half width width. Both are linear, so averaging first smooths only once.
+    """
+    return boxcar(np.mean(data, axis=0), width)
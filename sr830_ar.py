@@ -3,12 +3,13 @@
 
 import re
 import time
-from time import sleep
+from contextlib import nullcontext
 import numpy as np
 from enum import IntFlag
 from pymeasure.instruments import Instrument
 from pymeasure.instruments.validators import strict_discrete_set, \
     truncated_discrete_set, truncated_range, discreteTruncate
+from autorange import AutoRangeMixin
 
 
 class LIAStatus(IntFlag):
@@ -37,7 +38,7 @@ class ERRStatus(IntFlag):
     MATH_ERR = 128
 
 
-class SR830_ar(Instrument):
+class SR830_ar(AutoRangeMixin, Instrument):
     SAMPLE_FREQUENCIES = [
         62.5e-3, 125e-3, 250e-3, 500e-3, 1, 2, 4, 8, 16,
         32, 64, 128, 256, 512
@@ -69,6 +70,16 @@ class SR830_ar(Instrument):
     INPUT_FILTER = ['Off', 'On']
     model = "SR830"
 
+    # commands used by AutoRanger
+    SEN_QUERY = "SENS?"
+    SEN_SET = "SENS%d"
+    TC_QUERY = "OFLT?"
+    TC_SET = "OFLT%d"
+    RANGE_WRITES = r"(SENS|OFLT) *\d|AGAN"
+    SEN_INDEX_LIMITS = (0, len(SENSITIVITIES) - 1)
+    AUTO_RANGE_TC = 8
+    AUTO_RANGE_SETTLE = 5
+
     status = Instrument.measurement(
         "*STB?",
         """Get the status byte and Master Summary Status bit.""",
@@ -476,31 +487,12 @@ class SR830_ar(Instrument):
             newsensitivity = newsensitivity * 1e6
         self.sensitivity = newsensitivity
     
-    def auto_range(self):
-        ### increase or decrease sensitivity by one step when magnitude of signal is out of 0.1-0.9 of current sensitivity scale
-        # sensitivity = self.sensitivity
-        # if abs(self.magnitude) > 0.9*sensitivity:
-        #     while abs(self.magnitude) > 0.9*sensitivity:
-        #         self.write("SENS%d" % (int(self.ask("SENS?")) + 1))
-        #         sensitivity = self.sensitivity
-        # elif abs(self.magnitude) < 0.1*sensitivity:
-        #     while abs(self.magnitude) < 0.1*sensitivity:
-        #         self.write("SENS%d" % (int(self.ask("SENS?")) - 1))
-        #         sensitivity = self.sensitivity
-
-        if self.magnitude > 0.9*self.sensitivity or self.magnitude < 0.1*self.sensitivity:
-            while abs(int(self.ask("OUTP?3"))) > 0.9*self.sensitivity or abs(int(self.ask("OUTP?3"))) < 0.1*self.sensitivity:
-                ### need to change sensitivity, then change time constant to 0.1s to capture the quick change
-                current_tc = int(self.ask("OFLT?"))
-                self.write("OFLT8")
-                current_sen = int(self.ask("SENS?"))
-                if abs(int(self.ask("OUTP?3"))) > 9000:
-                    self.write("SENS%d" % (current_sen + 1))
-                elif abs(int(self.ask("OUTP?3"))) < 1000:
-                    self.write("SENS%d" % (current_sen - 1))
-                sleep(1) # give lock-in 1s to settle before checking again
-            self.write("OFLT%d" % current_tc) ### change back to original time constant
-            sleep(5) ### give lock-in 5s to settle before measuring
+    def range_fraction(self):
+        """ Returns the magnitude as a fraction of the sensitivity, used by auto_range
+        to keep the signal within 0.1-0.9 of the current sensitivity scale
+        """
+        self.last_range_fraction = abs(float(self.ask("OUTP?3"))) / self.SENSITIVITIES[self.sensitivity_index]
+        return self.last_range_fraction
 
     @property
     def buffer_count(self):
@@ -592,6 +584,64 @@ class SR830_ar(Instrument):
     def reset_buffer(self):
         self.write("REST")
 
+    def stream_buffer(self, sample_frequency=512, poll_time=0.1, restart_count=16000,
+                      lock=None, chunk_done=None):
+        """ Continuously record X and Y into the buffer in fast mode and yield new
+        points as they arrive, so the buffer can be drained while acquisition continues.
+
+        The buffer holds 16383 points, so once restart_count points are recorded it is
+        paused, drained and restarted. Only this restart leaves a gap in the stream.
+        The buffer holds X and Y in volts, so a range change while recording does not
+        change the scaling of the points already recorded.
+
+        :param sample_frequency: buffer sample rate in Hz, 512 is the fastest
+        :param poll_time: time in s to wait between checks for new points
+        :param restart_count: number of points after which the buffer is restarted
+        :param lock: held around every command, but not while waiting for points
+        :param chunk_done: called with the lock held after each chunk is read, e.g. to
+            step auto-ranging between chunks
+        :return: generator of (times, dict of 'x' and 'y' numpy arrays) for each new chunk
+        """
+        lock = lock if lock is not None else nullcontext()
+        with lock:
+            self.channel1 = 'X'
+            self.channel2 = 'Y'
+            self.sample_frequency = sample_frequency
+            self.write("SEND0") # one shot, stop at the end of the buffer instead of overwriting it
+        while True:
+            with lock:
+                self.reset_buffer()
+                self.start_buffer(fast=True)
+                start = time.monotonic() + 0.5 # STRD starts the scan after 0.5 s
+            index = 0
+            try:
+                while index < restart_count:
+                    time.sleep(poll_time)
+                    with lock:
+                        count = self.buffer_count
+                        if count > index:
+                            chunk = self._read_stream_chunk(index, count, chunk_done)
+                    if count > index:
+                        yield start + np.arange(index, count) / sample_frequency, chunk
+                        index = count
+            finally:
+                with lock:
+                    self.pause_buffer()
+            ### drain the points recorded since the last check before restarting
+            with lock:
+                count = self.buffer_count
+                if count > index:
+                    chunk = self._read_stream_chunk(index, count, chunk_done)
+            if count > index:
+                yield start + np.arange(index, count) / sample_frequency, chunk
+
+    def _read_stream_chunk(self, index, count, chunk_done):
+        chunk = {'x': self.get_buffer(1, index, count),
+                 'y': self.get_buffer(2, index, count)}
+        if chunk_done is not None:
+            chunk_done()
+        return chunk
+
     def trigger(self):
         self.write("TRIG")
 
@@ -623,6 +673,18 @@ class SR830_ar(Instrument):
         command = "SNAP? " + ",".join(vals_idx)
         return self.values(command)
 
+    def fast_read(self, reference=False):
+        """ Read X and Y in volts from the same instant in one SNAP? transaction,
+        without auto-ranging first.
+
+        :param reference: if True, the frequency in Hz is taken in the same SNAP?
+            and the sine output amplitude in volts is appended, i.e.
+            [x, y, frequency, amplitude] is returned instead of [x, y]
+        """
+        if reference:
+            return self.values("SNAP? 1,2,9") + [self.sine_voltage]
+        return self.values("SNAP? 1,2")
+
     def save_setup(self, setup_number: int):
         """Save the current instrument configuration (all parameters) in a memory
         referred to by an integer